@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+'''
+Admission control: token buckets limiting how fast a client may call, per address and per route.
+'''
+
+__author__ = 'Minty'
+
+import time
+from collections import OrderedDict
+
+class TokenBucket(object):
+    '''
+    Holds up to burst tokens, refilled at rate tokens per second. Every request takes one.
+    '''
+    __slots__ = ('rate', 'burst', 'tokens', 'at')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.at = time.monotonic()
+
+    def take(self, now):
+        ' 0 when a token was taken, else the seconds until the next one. '
+        self.tokens = min(self.burst, self.tokens + (now - self.at) * self.rate)
+        self.at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class RateLimiter(object):
+    '''
+    A token bucket per key (client address), the least recently seen keys are forgotten beyond maxsize.
+    A forgotten client starts again with a full bucket, which is what an idle client would have anyway.
+    '''
+    def __init__(self, rate, burst, maxsize = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+
+    def hit(self, key):
+        ' 0 when key may go on, else the seconds it should wait. '
+        bucket = self._buckets.get(key, None)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last = False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.take(time.monotonic())
+
+    def __len__(self):
+        return len(self._buckets)
@@ -6,7 +6,7 @@ __author__ = 'Minty'
 JSON API definition.
 '''
 
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64, binascii
 
 class Page(object):
     '''
@@ -29,12 +29,43 @@ class Page(object):
             self.limit = self.page_size
         self.has_next = self.page_index < self.page_count
         self.has_previous = self.page_index > 1
+        self.next_cursor = None
+        self.previous_cursor = None
+
+    def set_cursors(self, items):
+        '''
+        Set opaque next/previous cursors from the first and last item of the current page.
+        '''
+        if not items:
+            return
+        if self.has_next:
+            self.next_cursor = encode_cursor(items[-1])
+        if self.has_previous:
+            self.previous_cursor = encode_cursor(items[0])
 
     def __str__(self):
         return 'item_count: {}, page_count: {}, page_index: {}, page_size: {}, offset: {}, limit: {}'.format(self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
 
     __repr__ = __str__
 
+def encode_cursor(item):
+    '''
+    Encode the (created_at, id) keyset of an item into an opaque url-safe cursor.
+    '''
+    s = json.dumps([item.created_at, item.id], separators = (',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    '''
+    Decode a cursor made by encode_cursor() back into a (created_at, id) tuple.
+    '''
+    try:
+        s = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        created_at, id = json.loads(s)
+        return float(created_at), str(id)
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        raise APIValueError('cursor', 'Invalid page cursor.')
+
 class APIError(Exception):
     '''
     the base APIError which contains error(required), data(optional) and message(optional).
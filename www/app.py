@@ -5,13 +5,17 @@ __author__ = 'Minty'
 import logging
 logging.basicConfig(level = logging.INFO)
 
-import asyncio, os, json, time
+import asyncio, hashlib, math, os, json, signal, socket, time
 from datetime import datetime
+from email.utils import formatdate
 
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
-import orm
+import assets, compress, orm, search, serialize
+from admission import RateLimiter
+from cache import page_cache, version_cache
+from metrics import Counter, Gauge, Histogram
 from coroweb import add_routes, add_static
 
 from config import configs
@@ -32,25 +36,135 @@ def init_jinja2(app, **kw):
     path = kw.get('path', None)
     if not path:
         path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+    # compiled templates kept on disk, so restarts and other workers skip compiling them again
+    bytecode_cache = kw.get('bytecode_cache', None)
+    if bytecode_cache:
+        os.makedirs(bytecode_cache, exist_ok = True)
+        options['bytecode_cache'] = FileSystemBytecodeCache(bytecode_cache)
     env = Environment(loader = FileSystemLoader(path), **options)
     filters = kw.get('filters', None)
     if filters:
         for name, f in filters.items():
             env.filters[name] = f
+    functions = kw.get('globals', None)
+    if functions:
+        env.globals.update(functions)
+    # load every page before serving, so no request pays for it
+    if kw.get('preload', False):
+        names = env.list_templates(filter_func = lambda name: name.endswith('.html'))
+        for name in names:
+            env.get_template(name)
+        logging.info('preloaded {} templates'.format(len(names)))
     app['__template__'] = env
 
+BYTES_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+http_requests = Counter('http_requests_total', 'HTTP requests by route template, method and status.', ['route', 'method', 'status'])
+http_seconds = Histogram('http_request_seconds', 'Time to produce an HTTP response.', ['route', 'method'])
+http_request_bytes = Histogram('http_request_bytes', 'Size of HTTP request bodies.', ['route', 'method'], BYTES_BUCKETS)
+http_response_bytes = Histogram('http_response_bytes', 'Size of HTTP response bodies.', ['route', 'method'], BYTES_BUCKETS)
+http_in_flight = Gauge('http_requests_in_flight', 'HTTP requests being handled.', ['route'])
+http_rejected = Counter('http_rejected_total', 'HTTP requests refused by admission control.', ['reason'])
+
 # new style middleware: https://aiohttp.readthedocs.io/en/stable/web_advanced.html#aiohttp-web-middlewares
+# middleware to measure every request, by the route it matched (/blog/{id}) rather than its path
+@web.middleware
+async def metrics_middleware(request, handler):
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else 'unmatched'
+    method = request.method
+    started = time.perf_counter()
+    http_in_flight.inc(route = route)
+    status = 500
+    try:
+        r = await handler(request)
+        status = r.status
+        size = r.content_length
+        if size is None:
+            # streamed responses are written by the time the handler returns
+            size = getattr(r, 'body_length', 0)
+        http_response_bytes.observe(size, route = route, method = method)
+        return r
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        http_in_flight.dec(route = route)
+        http_seconds.observe(time.perf_counter() - started, route = route, method = method)
+        http_request_bytes.observe(request.content_length or 0, route = route, method = method)
+        http_requests.inc(route = route, method = method, status = status)
+
+ip_limiter = RateLimiter(configs.admission.ip_rate, configs.admission.ip_burst, configs.admission.clients)
+route_limiters = {route: RateLimiter(c.rate, c.burst, configs.admission.clients) for route, c in configs.admission.routes.items()}
+# requests admitted and not answered yet
+_admitted = 0
+
+def refuse(status, retry_after, reason):
+    http_rejected.inc(reason = reason)
+    return web.Response(status = status, text = '{}: {}'.format(status, 'Too Many Requests' if status == 429 else 'Service Unavailable'),
+        headers = {'Retry-After': str(max(1, math.ceil(retry_after)))})
+
+# middleware to refuse requests early instead of queueing them for the database:
+# clients over their rate get 429, and everybody gets 503 while the server is saturated
+@web.middleware
+async def admission_middleware(request, handler):
+    global _admitted
+    # static files and metrics need neither the database nor much time
+    if request.path.startswith('/static/') or request.path == '/metrics':
+        return await handler(request)
+    c = configs.admission
+    wait = ip_limiter.hit(request.remote)
+    if wait:
+        return refuse(429, wait, 'ip')
+    resource = request.match_info.route.resource
+    limiter = route_limiters.get('{} {}'.format(request.method, resource.canonical), None) if resource is not None else None
+    if limiter is not None:
+        wait = limiter.hit(request.remote)
+        if wait:
+            return refuse(429, wait, 'route')
+    if _admitted >= c.max_in_flight:
+        return refuse(503, c.retry_after, 'in_flight')
+    if orm.pool_wait() > c.max_pool_wait:
+        return refuse(503, c.retry_after, 'pool_wait')
+    _admitted += 1
+    try:
+        return await handler(request)
+    except orm.PoolTimeout as e:
+        logging.warning(str(e))
+        return refuse(503, c.retry_after, 'pool_timeout')
+    finally:
+        _admitted -= 1
+
 # middleware to log
 @web.middleware
 async def logger_middleware(request, handler):
     logging.info('Request: {} {}'.format(request.method, request.path))
     return await handler(request)
 
+# cookie telling that the client wrote recently
+PRIMARY_COOKIE = 'awereadprimary'
+
+# middleware to keep a client reading from the primary database for a moment after it wrote,
+# so that lagging replicas do not hide its own changes on the next page
+@web.middleware
+async def read_your_writes_middleware(request, handler):
+    if not configs.db.replicas:
+        return await handler(request)
+    if request.cookies.get(PRIMARY_COOKIE):
+        orm.use_primary()
+    r = await handler(request)
+    if request.method != 'GET' and orm.reading_primary() and isinstance(r, web.StreamResponse) and not r.prepared:
+        r.set_cookie(PRIMARY_COOKIE, '1', max_age = configs.db.read_your_writes, httponly = True)
+    return r
+
 # middleware to find user by cookie and add it to request
 @web.middleware
 async def auth_middleware(request, handler):
     logging.info('check user: {} {}'.format(request.method, request.path))
     request.__user__ = None
+    # static files never depend on the user
+    if request.path.startswith('/static/'):
+        return await handler(request)
     cookie_str = request.cookies.get(COOKIE_NAME)
     if cookie_str:
         logging.info('cookie exists')
@@ -62,6 +176,126 @@ async def auth_middleware(request, handler):
         return web.HTTPFound('/signin')
     return await handler(request)
 
+def not_modified(request, etag, last_modified):
+    ' whether the client copy validated by etag and last_modified is current. If-None-Match wins over If-Modified-Since. '
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [t.strip() for t in if_none_match.split(',')]
+        # weak comparison: W/"x" and "x" match
+        return '*' in tags or etag in tags or etag[2:] in tags
+    since = request.if_modified_since
+    return last_modified is not None and since is not None and int(last_modified) <= since.timestamp()
+
+# middleware to answer conditional GETs with 304 Not Modified from the validator of a view,
+# before anything is loaded, rendered or serialized
+@web.middleware
+async def conditional_middleware(request, handler):
+    validator = getattr(request.match_info.handler, '__validator__', None)
+    if request.method not in ('GET', 'HEAD') or validator is None:
+        return await handler(request)
+    # validators only depend on the path, and are read once for all the requests of a spike
+    validated = await version_cache.load(request.path, lambda: validator(request))
+    if validated is None:
+        return await handler(request)
+    last_modified, version = validated
+    # pages show who is signed in, and change with the templates and static files of a deploy
+    user = request.__user__
+    viewer = (user.id, user.name, user.admin) if user is not None else None
+    tag = hashlib.md5(repr((version, viewer, request.app['__site_version__'])).encode('utf-8')).hexdigest()[:20]
+    headers = {'ETag': 'W/"{}"'.format(tag), 'Cache-Control': 'private, no-cache'}
+    if last_modified:
+        headers['Last-Modified'] = formatdate(last_modified, usegmt = True)
+    else:
+        last_modified = None
+    if not_modified(request, headers['ETag'], last_modified):
+        return web.Response(status = 304, headers = headers)
+    # cached pages must have been rendered at this version to be served under its etag
+    request.__version__ = tag
+    r = await handler(request)
+    # the version was read before the view ran, so a write in between only makes the next request render again
+    if isinstance(r, web.StreamResponse) and r.status == 200 and not r.prepared:
+        r.headers.update(headers)
+    return r
+
+def site_version(app):
+    '''
+    Fingerprint of the templates and static files, which validators of rendered pages depend on.
+    '''
+    env = app['__template__']
+    h = hashlib.md5()
+    for name in sorted(env.list_templates()):
+        h.update(name.encode('utf-8'))
+        h.update(env.loader.get_source(env, name)[0].encode('utf-8'))
+    h.update(json.dumps(assets.manifest, sort_keys = True).encode('utf-8'))
+    return h.hexdigest()
+
+class CachedPage(object):
+    '''
+    Rendered body of a response, which can build a fresh web.Response for every request.
+    Compressed forms of the body are kept too, so a hot page is compressed once per encoding.
+    version is the validated version the page was rendered at, None for views without a validator.
+    '''
+    def __init__(self, body, content_type, version = None):
+        self.body = body
+        self.content_type = content_type
+        self.version = version
+        self.compressible = compress.compressible(content_type, len(body))
+        self.encoded = dict()
+
+    def response(self, request):
+        headers = {'Content-Type': self.content_type}
+        if not self.compressible:
+            return web.Response(body = self.body, headers = headers)
+        headers['Vary'] = 'Accept-Encoding'
+        encoding = compress.negotiate(request.headers.get('Accept-Encoding'))
+        if encoding is None:
+            return web.Response(body = self.body, headers = headers)
+        body = self.encoded.get(encoding, None)
+        if body is None:
+            body = self.encoded[encoding] = compress.compress(self.body, encoding)
+        headers['Content-Encoding'] = encoding
+        return web.Response(body = body, headers = headers)
+
+# middleware to serve rendered pages from cache to anonymous users, only one request renders a missing page
+@web.middleware
+async def page_cache_middleware(request, handler):
+    if request.method != 'GET' or request.__user__ is not None or not getattr(request.match_info.handler, '__page_cache__', False):
+        return await handler(request)
+    version = getattr(request, '__version__', None)
+    rendered = None
+    async def render():
+        nonlocal rendered
+        rendered = await handler(request)
+        if type(rendered) is web.Response and rendered.status == 200 and rendered.body is not None:
+            return CachedPage(rendered.body, rendered.headers.get('Content-Type'), version)
+        return None
+    key = request.path_qs
+    page = await page_cache.load(key, render)
+    if page is not None and page.version != version:
+        # rendered before a change this worker only learnt of from the validator, by a write of another worker
+        page_cache.evict(lambda k: k == key)
+        page = await page_cache.load(key, render)
+    if page is not None:
+        return page.response(request)
+    # not cacheable: the request that rendered returns its own response, the others render again
+    return rendered if rendered is not None else await handler(request)
+
+# middleware to compress html and json bodies for clients which accept it.
+# responses which are already encoded, like cached pages and static files, are left alone
+@web.middleware
+async def compression_middleware(request, handler):
+    r = await handler(request)
+    if type(r) is not web.Response or r.status != 200 or not isinstance(r.body, bytes) or 'Content-Encoding' in r.headers:
+        return r
+    if not compress.compressible(r.content_type, len(r.body)):
+        return r
+    r.headers['Vary'] = 'Accept-Encoding'
+    encoding = compress.negotiate(request.headers.get('Accept-Encoding'))
+    if encoding is not None:
+        r.body = compress.compress(r.body, encoding)
+        r.headers['Content-Encoding'] = encoding
+    return r
+
 # middleware to produce response in right format
 @web.middleware
 async def response_middleware(request, handler):
@@ -85,13 +319,12 @@ async def response_middleware(request, handler):
     if isinstance(r, dict):
         template = r.get('__template__', None)
         if template is None:
-            resp = web.Response(
-                body = json.dumps(r, ensure_ascii = False, default = lambda obj: obj.__dict__).encode('utf-8'))
+            resp = web.Response(body = serialize.dumps(r))
             resp.content_type = 'application/json;charset=utf-8'
             return resp
         else:
             r['__user__'] = request.__user__
-            resp = web.Response(body = request.app['__template__'].get_template(template).render(**r))
+            resp = web.Response(body = request.app['__template__'].get_template(template).render(**r).encode('utf-8'))
             resp.content_type = 'text/html;charset=utf-8'
             return resp
     if isinstance(r, int) and (100 <= r < 600):
@@ -122,16 +355,106 @@ def datetime_filter(t):
     dt = datetime.fromtimestamp(t)
     return u'{}/{}/{}'.format(dt.month, dt.day, dt.year)
 
-async def init(loop):
-    await orm.create_pool(loop, **configs['db'])
-    app = web.Application(loop = loop, middlewares = [logger_middleware, auth_middleware, response_middleware])
-    init_jinja2(app, filters = dict(datetime = datetime_filter))
+async def init(loop, sock = None):
+    # every worker process opens its own pool
+    await orm.create_pool(loop, **dict(configs.db, maxsize = configs.server.pool_size))
+    app = web.Application(loop = loop, middlewares = [metrics_middleware, admission_middleware, logger_middleware, read_your_writes_middleware, auth_middleware, conditional_middleware, compression_middleware, page_cache_middleware, response_middleware])
+    init_jinja2(app, filters = dict(datetime = datetime_filter), globals = dict(static_url = assets.static_url), **configs.templates)
     add_routes(app, 'handlers')
-    add_static(app)
-    srv = await loop.create_server(app.make_handler(), 'localhost', 9000)
-    logging.info('server started at http://127.0.0.1:9000 ...')
-    return srv
-
-loop = asyncio.get_event_loop()
-loop.run_until_complete(init(loop))
-loop.run_forever()
\ No newline at end of file
+    if not configs.static.build or not assets.add_assets(app, configs.static.build):
+        add_static(app)
+    app['__site_version__'] = site_version(app)
+    await search.build()
+    handler = app.make_handler()
+    # the pool is warm by now: connections are taken only once everything else is ready
+    if sock is None:
+        srv = await loop.create_server(handler, configs.server.host, configs.server.port)
+    else:
+        srv = await loop.create_server(handler, sock = sock)
+    logging.info('server started at http://{}:{} (pid {}) ...'.format(configs.server.host, configs.server.port, os.getpid()))
+    return srv, handler
+
+async def shutdown(loop, srv, handler):
+    '''
+    Stop accepting, give requests in flight drain_timeout seconds to finish, then close the database pool.
+    '''
+    logging.info('worker {} draining ...'.format(os.getpid()))
+    srv.close()
+    await handler.shutdown(configs.server.drain_timeout)
+    await search.search_index.flush()
+    await orm.destroy_pool()
+    logging.info('worker {} stopped'.format(os.getpid()))
+    loop.stop()
+
+def serve(sock = None):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    srv, handler = loop.run_until_complete(init(loop, sock))
+    stopping = []
+    def stop():
+        if not stopping:
+            stopping.append(loop.create_task(shutdown(loop, srv, handler)))
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop)
+    loop.run_forever()
+
+def prefork(workers):
+    '''
+    Listen once, fork workers which all accept on the inherited socket, and restart the ones which die.
+    '''
+    sock = socket.socket(socket.AF_INET6 if ':' in configs.server.host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((configs.server.host, configs.server.port))
+    sock.listen(configs.server.backlog)
+    sock.setblocking(False)
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            # the worker must not run the supervisor's signal handlers
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                serve(sock)
+            except BaseException:
+                logging.exception('worker {} crashed'.format(os.getpid()))
+                code = 1
+            finally:
+                os._exit(code)
+        children.add(pid)
+        logging.info('started worker {}'.format(pid))
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    for i in range(workers):
+        spawn()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            logging.warning('worker {} exited with status {}, restarting ...'.format(pid, status))
+            # do not spin when workers die at startup
+            time.sleep(1)
+            # a stop signal during the sleep would never reach the new worker
+            if not stopping:
+                spawn()
+    sock.close()
+
+if __name__ == '__main__':
+    workers = configs.server.workers or os.cpu_count() or 1
+    if workers > 1 and hasattr(os, 'fork'):
+        prefork(workers)
+    else:
+        serve()
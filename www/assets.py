@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+'''
+Static files for production: a build step which copies www/static under content-hashed names,
+with precompressed .gz/.br variants and a manifest, and a handler serving the result.
+
+Hashed files never change, so clients may keep them forever: a new build gives new names,
+and templates pick them up through static_url().
+
+Usage: python assets.py [build directory, static_build by default]
+'''
+
+__author__ = 'Minty'
+
+import asyncio, hashlib, json, logging, mimetypes, os, posixpath, re, sys
+
+from aiohttp import web
+
+import compress
+from cache import LRUCache
+from config import configs
+
+WWW_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(WWW_DIR, 'static')
+MANIFEST = 'manifest.json'
+
+# url(...) references of stylesheets, like url(../fonts/fontawesome-webfont.eot?#iefix)
+CSS_URL = re.compile(r'''url\((['"]?)([^'")?#]+)([?#][^'")]*)?\1\)''')
+
+# original name => hashed name, of the build being served
+manifest = dict()
+
+def static_url(name):
+    ' url of a file under www/static, hashed when a build is served. '
+    return '/static/' + manifest.get(name, name)
+
+def fingerprint(data):
+    return hashlib.md5(data).hexdigest()[:12]
+
+def hashed_name(name, data):
+    base, ext = posixpath.splitext(name)
+    return '{}.{}{}'.format(base, fingerprint(data), ext)
+
+def rewrite_css(name, data, hashed):
+    ' point url(...) references of a stylesheet to the hashed names of the files. '
+    folder = posixpath.dirname(name)
+    def repl(m):
+        target = posixpath.normpath(posixpath.join(folder, m.group(2)))
+        if target not in hashed:
+            return m.group(0)
+        return 'url({0}{1}{2}{0})'.format(m.group(1), posixpath.relpath(hashed[target], folder), m.group(3) or '')
+    return CSS_URL.sub(repl, data.decode('utf-8')).encode('utf-8')
+
+def write(dest, name, data):
+    ' write a built file, and its compressed variants when they are worth it. '
+    path = os.path.join(dest, *name.split('/'))
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    if not compress.compressible(mimetypes.guess_type(name)[0], len(data)):
+        return
+    for encoding in compress.ENCODINGS:
+        encoded = compress.compress(data, encoding, best = True)
+        if len(encoded) < len(data):
+            with open(path + compress.SUFFIXES[encoding], 'wb') as f:
+                f.write(encoded)
+
+def build(dest, src = STATIC_DIR):
+    '''
+    Copy every file of src into dest under its own name and its hashed name, and write the manifest.
+    Files of earlier builds are kept, pages rendered before a deploy may still refer to them.
+    '''
+    names = []
+    for root, dirs, files in os.walk(src):
+        for f in files:
+            names.append(os.path.relpath(os.path.join(root, f), src).replace(os.sep, '/'))
+    # stylesheets refer to fonts and images, which must have their hashed names first
+    names.sort(key = lambda name: (name.endswith('.css'), name))
+    hashed = dict()
+    for name in names:
+        with open(os.path.join(src, *name.split('/')), 'rb') as f:
+            data = f.read()
+        if name.endswith('.css'):
+            data = rewrite_css(name, data, hashed)
+        hashed[name] = hashed_name(name, data)
+        write(dest, name, data)
+        write(dest, hashed[name], data)
+    with open(os.path.join(dest, MANIFEST), 'w') as f:
+        json.dump(hashed, f, indent = 2, sort_keys = True)
+    logging.info('built {} static files into {}'.format(len(names), dest))
+    return hashed
+
+def load_manifest(path):
+    ' manifest of the build in path, None if it was not built. '
+    try:
+        with open(os.path.join(path, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+class StaticHandler(object):
+    '''
+    Serve a built static directory: precompressed variants by Accept-Encoding,
+    far-future caching for hashed names, and small files from memory.
+    '''
+    def __init__(self, path, hashed, cache_size = 200, cache_max_file = 256 * 1024, cache_ttl = 3600):
+        self._path = os.path.abspath(path)
+        self._immutable = set(hashed.values())
+        self._max_file = cache_max_file
+        # name => (content type, {encoding or None: body})
+        self._cache = LRUCache(cache_size, cache_ttl)
+
+    async def _load(self, name, path):
+        bodies = dict()
+        loop = asyncio.get_event_loop()
+        bodies[None] = await loop.run_in_executor(None, read_file, path)
+        for encoding in compress.ENCODINGS:
+            variant = path + compress.SUFFIXES[encoding]
+            if os.path.isfile(variant):
+                bodies[encoding] = await loop.run_in_executor(None, read_file, variant)
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type == 'application/javascript':
+            content_type += '; charset=utf-8'
+        return content_type, bodies
+
+    async def __call__(self, request):
+        name = request.match_info['name']
+        path = os.path.normpath(os.path.join(self._path, *name.split('/')))
+        if not path.startswith(self._path + os.sep) or name.endswith(tuple(compress.SUFFIXES.values())):
+            raise web.HTTPNotFound()
+        entry = self._cache.get(name)
+        if entry is None:
+            if not os.path.isfile(path):
+                raise web.HTTPNotFound()
+            entry = await self._load(name, path)
+            if sum(len(body) for body in entry[1].values()) <= self._max_file:
+                self._cache.set(name, entry)
+        content_type, bodies = entry
+        headers = {'Content-Type': content_type}
+        if name in self._immutable:
+            headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            headers['Cache-Control'] = 'public, max-age=3600'
+        encoding = None
+        if len(bodies) > 1:
+            headers['Vary'] = 'Accept-Encoding'
+            encoding = compress.negotiate(request.headers.get('Accept-Encoding'), [e for e in compress.ENCODINGS if e in bodies])
+            if encoding is not None:
+                headers['Content-Encoding'] = encoding
+        return web.Response(body = bodies[encoding], headers = headers)
+
+def add_assets(app, path):
+    '''
+    Serve the build in path (relative to www/) under /static/, return False if there is none.
+    '''
+    path = os.path.join(WWW_DIR, path)
+    hashed = load_manifest(path)
+    if hashed is None:
+        logging.warning('no static build in {}, run "python assets.py {}" first'.format(path, path))
+        return False
+    manifest.clear()
+    manifest.update(hashed)
+    c = configs.static
+    app.router.add_route('GET', '/static/{name:.+}', StaticHandler(path, hashed, c.cache_size, c.cache_max_file, c.cache_ttl))
+    logging.info('add static {} => {} ({} hashed files)'.format('/static/', path, len(hashed)))
+    return True
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO)
+    build(os.path.join(WWW_DIR, sys.argv[1] if len(sys.argv) > 1 else configs.static.build or 'static_build'))
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+'''
+Render html_content of existing blogs and comments in batches.
+
+Add the columns first if the database was created before they existed:
+
+    alter table blogs add column `html_content` mediumtext not null after `content`;
+    alter table comments add column `html_content` mediumtext not null after `content`;
+
+Usage: python backfill_html.py [--all] [--batch-size N]
+'''
+
+__author__ = 'Minty'
+
+import asyncio, logging, sys
+
+import orm
+from config import configs
+from model import Blog, Comment
+
+async def backfill(model, batch_size, render_all = False):
+    where = None if render_all else "`html_content`=''"
+    total = 0
+    # walk the table by keyset, so every batch costs the same however far we are
+    columns = ['content', 'created_at']
+    rows = await model.findAll(where, orderBy = 'created_at desc, id desc', limit = batch_size, columns = columns)
+    while rows:
+        # beforeWrite() of the model renders html_content
+        await model.updateMany(rows, fields = ['html_content'])
+        total += len(rows)
+        logging.info('  {}: {} rows rendered'.format(model.__table__, total))
+        last = rows[-1]
+        rows = await model.findAll(where, after = (last.created_at, last.id), limit = batch_size, columns = columns)
+    return total
+
+async def main(loop, argv):
+    render_all = '--all' in argv
+    batch_size = 500
+    if '--batch-size' in argv:
+        batch_size = int(argv[argv.index('--batch-size') + 1])
+    await orm.create_pool(loop, **configs.db)
+    try:
+        await backfill(Blog, batch_size, render_all)
+        await backfill(Comment, batch_size, render_all)
+    finally:
+        await orm.destroy_pool()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, sys.argv[1:]))
+    loop.close()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+'''
+In-process caches.
+'''
+
+__author__ = 'Minty'
+
+import asyncio, time
+from collections import OrderedDict
+
+from config import configs
+from metrics import Gauge, collect
+
+class LRUCache(object):
+    '''
+    Cache bounded by size (least recently used entries go first) and by a time-to-live per entry.
+    '''
+    def __init__(self, maxsize = 1000, ttl = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default = None):
+        item = self._data.get(key, None)
+        if item is None:
+            self.misses += 1
+            return default
+        value, expires = item
+        if expires < time.time():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, expires = None):
+        ' store value until expires (a timestamp), but never longer than ttl. '
+        deadline = time.time() + self.ttl
+        if expires is not None:
+            deadline = min(deadline, expires)
+        self._data[key] = (value, deadline)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last = False)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def evict(self, predicate):
+        ' remove all entries whose key matches predicate. '
+        for key in [k for k in self._data if predicate(k)]:
+            del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return dict(size = len(self._data), maxsize = self.maxsize, hits = self.hits, misses = self.misses)
+
+class SingleFlightCache(LRUCache):
+    '''
+    LRUCache where concurrent misses on one key wait for a single load instead of loading in parallel.
+    '''
+    def __init__(self, maxsize = 1000, ttl = 300):
+        super().__init__(maxsize, ttl)
+        # key => future of the load in flight. evict() drops the matching keys,
+        # so a load that raced with an eviction of its own key is not stored
+        self._loading = dict()
+
+    async def load(self, key, loader):
+        ' return the cached value of key, or await loader() once for all concurrent callers. None results are not cached. '
+        value = self.get(key)
+        if value is not None:
+            return value
+        future = self._loading.get(key, None)
+        if future is not None:
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # the caller doing the load was cancelled, so take over
+                return await self.load(key, loader)
+        future = asyncio.get_event_loop().create_future()
+        self._loading[key] = future
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # mark retrieved: nobody may be waiting
+            future.exception()
+            raise
+        else:
+            if value is not None and self._loading.get(key, None) is future:
+                self.set(key, value)
+            future.set_result(value)
+        finally:
+            if self._loading.get(key, None) is future:
+                del self._loading[key]
+        return value
+
+    def evict(self, predicate):
+        super().evict(predicate)
+        for key in [k for k in self._loading if predicate(k)]:
+            del self._loading[key]
+
+# verified session cookie => User
+session_cache = LRUCache(configs.session.cache_size, configs.session.cache_ttl)
+
+# rendered pages for anonymous visitors: path with query => CachedPage
+page_cache = SingleFlightCache(configs.page_cache.size, configs.page_cache.ttl)
+
+# validated (last modified, version) of conditional views: path => tuple
+version_cache = SingleFlightCache(configs.page_cache.size, configs.page_cache.version_ttl)
+
+cache_hits = Gauge('cache_hits', 'Lookups answered from a cache since the worker started.', ['cache'])
+cache_misses = Gauge('cache_misses', 'Lookups a cache could not answer since the worker started.', ['cache'])
+cache_entries = Gauge('cache_entries', 'Entries held by a cache.', ['cache'])
+
+@collect
+def _collect_caches():
+    for name, cache in (('session', session_cache), ('page', page_cache), ('version', version_cache)):
+        stats = cache.stats()
+        cache_hits.set(stats['hits'], cache = name)
+        cache_misses.set(stats['misses'], cache = name)
+        cache_entries.set(stats['size'], cache = name)
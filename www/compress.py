@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+'''
+Gzip and brotli encoding of response bodies.
+'''
+
+__author__ = 'Minty'
+
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from config import configs
+
+# in order of preference
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+# file name suffix of precompressed static files
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+def accepted(header):
+    ' encodings the client accepts, from an Accept-Encoding header. '
+    result = set()
+    for item in (header or '').split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if coding and q > 0:
+            result.add(coding)
+    return result
+
+def negotiate(header, offered = ENCODINGS):
+    ' best encoding of offered which the client accepts, None to send the body as it is. '
+    codings = accepted(header)
+    for encoding in offered:
+        if encoding in codings or '*' in codings:
+            return encoding
+    return None
+
+def compressible(content_type, size):
+    ' whether a body is worth compressing: a text type of the allowlist, and not too small to gain anything. '
+    if size < configs.compression.min_size:
+        return False
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    return content_type in configs.compression.types
+
+def compress(body, encoding, best = False):
+    '''
+    Encode body. Responses use the configured levels, build time compression uses the best (and slowest) ones.
+    '''
+    if encoding == 'br':
+        return brotli.compress(body, quality = 11 if best else configs.compression.brotli_quality)
+    if encoding == 'gzip':
+        # fixed mtime, so the same input always gives the same bytes
+        return gzip.compress(body, 9 if best else configs.compression.gzip_level, mtime = 0)
+    raise ValueError('unknown encoding: {}'.format(encoding))
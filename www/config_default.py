@@ -8,14 +8,126 @@ __author__ = 'Minty'
 
 configs = {
     'debug': True,
+    'server': {
+        'host': 'localhost',
+        'port': 9000,
+        'backlog': 128,
+        # worker processes sharing the listen socket, 0 means one per cpu
+        'workers': 1,
+        # connection pool size of every worker
+        'pool_size': 10,
+        # seconds requests in flight may take to finish on SIGTERM
+        'drain_timeout': 10
+    },
     'db': {
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'root',
         'password': 'password',
-        'db': 'awesome'
+        'db': 'awesome',
+        # per-statement metrics, and a warning for statements slower than slow_query seconds
+        'instrument': True,
+        'slow_query': 0.5,
+        # read replicas, e.g. [{'host': '10.0.0.2'}], other settings are taken from the primary
+        'replicas': [],
+        # seconds between replica health checks
+        'replica_check': 5,
+        # seconds a client reads from the primary after it wrote
+        'read_your_writes': 5,
+        # connections opened at startup, before the server takes requests
+        'minsize': 5,
+        # seconds to wait for a free connection, then fail the statement
+        'acquire_timeout': 5,
+        # seconds after which connections are replaced, and idle time after which they are pinged before use
+        'pool_recycle': 3600,
+        'ping_after': 60,
+        # seconds inserts of batched models (comments) wait to share one transaction, at most batch_rows rows, None to write each at once
+        'batch_delay': 0.005,
+        'batch_rows': 100
     },
     'session': {
-        'secret': 'Awesome'
+        'secret': 'Awesome',
+        # verified cookies kept in memory to skip the user lookup. cache_ttl also bounds how long
+        # a changed password or admin flag takes to reach every worker, each has its own cache
+        'cache_size': 1000,
+        'cache_ttl': 300
+    },
+    'passwords': {
+        # pbkdf2_sha256 or scrypt, hashes of other algorithms or costs are replaced on sign-in
+        'algorithm': 'pbkdf2_sha256',
+        'iterations': 260000,
+        'scrypt_n': 16384,
+        'scrypt_r': 8,
+        'scrypt_p': 1,
+        # hashing runs on a 'thread' or 'process' pool of every worker, at most max_pending hashes wait for it
+        'executor': 'thread',
+        'workers': 2,
+        'max_pending': 100
+    },
+    'admission': {
+        # requests per second and burst of every client address, limits are per worker process
+        'ip_rate': 20,
+        'ip_burst': 60,
+        # tighter limits of a client on some routes
+        'routes': {
+            'POST /api/authenticate': {'rate': 0.2, 'burst': 5},
+            'POST /api/users': {'rate': 0.05, 'burst': 3},
+            'POST /api/blogs/{id}/comments': {'rate': 0.1, 'burst': 3}
+        },
+        # client addresses remembered by every limiter
+        'clients': 10000,
+        # beyond these requests in flight, or seconds waited for a database connection, answer 503 at once
+        'max_in_flight': 256,
+        'max_pool_wait': 0.5,
+        # seconds clients are told to wait after a 503
+        'retry_after': 1
+    },
+    'page_cache': {
+        'size': 500,
+        # pages show relative times like '5 mins ago', so do not keep them too long
+        'ttl': 60,
+        # seconds the versions of conditional views are kept: a conditional GET does not query the database,
+        # writes of this worker drop them at once, writes of other workers show after version_ttl
+        'version_ttl': 5
+    },
+    'templates': {
+        # check template files for changes on every render, turn off in production
+        'auto_reload': True,
+        # directory for compiled templates, shared by workers and restarts. None to compile in memory only
+        'bytecode_cache': None,
+        # load all templates at startup
+        'preload': False
+    },
+    'static': {
+        # directory built by "python assets.py", served with hashed names and far-future caching.
+        # None serves www/static as it is, for development
+        'build': None,
+        # small files kept in memory
+        'cache_size': 200,
+        'cache_max_file': 256 * 1024,
+        'cache_ttl': 3600
+    },
+    'compression': {
+        # bodies smaller than this gain nothing from compression
+        'min_size': 1024,
+        'types': ['text/html', 'text/plain', 'text/css', 'text/javascript', 'application/javascript', 'application/json',
+            'image/svg+xml', 'font/ttf', 'font/otf', 'application/vnd.ms-fontobject'],
+        # for responses, build time compression of static files uses the best levels
+        'gzip_level': 6,
+        'brotli_quality': 5
+    },
+    'search': {
+        # directory of the search index, relative to www/
+        'path': 'search_index',
+        # changes journaled before they are folded into a new snapshot
+        'compact_after': 1000
+    },
+    'metrics': {
+        # addresses allowed to read /metrics. behind a reverse proxy on the same host every request comes
+        # from 127.0.0.1, so anyone reaching the proxy passes: set a token then, or keep /metrics off the proxy
+        'allow': ['127.0.0.1', '::1'],
+        # when set, /metrics wants 'Authorization: Bearer <token>' (bearer_token of a prometheus scrape job)
+        # instead of an allowed address
+        'token': None
     }
 }
\ No newline at end of file
@@ -4,7 +4,6 @@ __author__ = 'Minty'
 
 import asyncio, functools, inspect, logging, os
 from aiohttp import web
-from urllib import parse
 from apis import APIError
 
 logging.basicConfig(level = logging.INFO)
@@ -25,6 +24,20 @@ def Handler_decorator(path, *, method):
 get = functools.partial(Handler_decorator, method = 'GET')
 post = functools.partial(Handler_decorator, method = 'POST')
 
+# decorator for GET view functions whose rendered page can be cached and shared between anonymous users
+def cache_page(func):
+    func.__page_cache__ = True
+    return func
+
+# decorator for GET view functions which answer conditional requests without running.
+# async validator(request) returns (last modified timestamp or None, version) of what the view shows,
+# or None when it cannot tell. results are cached by path, see invalidate_pages() of handlers
+def conditional(validator):
+    def decorator(func):
+        func.__validator__ = validator
+        return func
+    return decorator
+
 '''
 link: http://docs.python.org/3/library/inspect.html#inspect.Parameter
 
@@ -85,7 +98,28 @@ def has_request_arg(fn):
             raise ValueError('request parameter must be the last parameter in function: {}'.format(fn.__name__))
     return found
 
+# convert query or form strings for parameters annotated with a type, e.g. page: int
+def to_bool(v):
+    if isinstance(v, bool):
+        return v
+    return str(v).lower() in ('1', 'true', 'yes', 'on')
+
+CONVERTERS = {
+    int: int,
+    float: float,
+    bool: to_bool
+}
+
+def get_converters(fn):
+    converters = dict()
+    params = inspect.signature(fn).parameters
+    for name, param in params.items():
+        if param.annotation in CONVERTERS:
+            converters[name] = CONVERTERS[param.annotation]
+    return converters
+
 # RequestHandler analyze the parameters of view function, abstract them from web.Request, call view function, then process the result into web.Response
+# all decisions depending on the view function are taken once here, so a request only does the work its view function needs
 class RequestHandler(object):
 
     def __init__(self, app, fn):
@@ -96,51 +130,78 @@ class RequestHandler(object):
         self._has_request_arg = has_request_arg(fn)
         self._has_named_kw_arg = has_named_kw_arg(fn)
         self._has_var_kw_arg = has_var_kw_arg(fn)
+        self._converters = get_converters(fn)
+        self._has_path_args = '{' in getattr(fn, '__route__', '')
+        self.__page_cache__ = getattr(fn, '__page_cache__', False)
+        self.__validator__ = getattr(fn, '__validator__', None)
+        # binder of request data: body for POST, query string for GET
+        if not (self._has_named_kw_arg or self._has_var_kw_arg):
+            self._read_args = self._read_nothing
+        elif getattr(fn, '__method__', None) == 'POST':
+            self._read_args = self._read_body
+        elif self._has_var_kw_arg:
+            self._read_args = self._read_query
+        else:
+            self._read_args = self._read_named_query
 
-    async def __call__(self, request):
-        kw = None
-        if self._has_named_kw_arg or self._has_var_kw_arg:
-
-            if request.method == 'POST':
-                # return error 400 if content_type doesn't exist
-                if request.content_type == None:
-                    return web.HTTPBadRequest(text = 'Missing Content_Type.')
-                ct = request.content_type.lower()
-                # json format
-                if ct.startswith('application/json'):
-                    params = await request.json()
-                    if not isinstance(params, dict):
-                        return web.HTTPBadRequest(text = 'JSON body must be object.')
-                    kw = params
-                # form format
-                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-                    params = await request.post()
-                    kw = dict(**params)
-                else:
-                    return web.HTTPBadRequest(text = 'Unsupported Content_Type: {}'.format(request.content_type))
-
-            elif request.method == 'GET':
-                # the query part in url request after ?
-                qs = request.query_string
-                if qs:
-                    kw = dict()
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
-
-        if kw is None:
-            kw = dict(**request.match_info)
+    async def _read_nothing(self, request):
+        return dict()
+
+    async def _read_query(self, request):
+        kw = dict()
+        # the query part in url request after ?, first value of every name
+        for k, v in request.query.items():
+            if k not in kw:
+                kw[k] = v
+        return kw
+
+    async def _read_named_query(self, request):
+        query = request.query
+        kw = dict()
+        for name in self._named_kw_args:
+            if name in query:
+                kw[name] = query[name]
+        return kw
+
+    async def _read_body(self, request):
+        # return error 400 if content_type doesn't exist
+        if request.content_type == None:
+            return web.HTTPBadRequest(text = 'Missing Content_Type.')
+        ct = request.content_type.lower()
+        # json format
+        if ct.startswith('application/json'):
+            params = await request.json()
+            if not isinstance(params, dict):
+                return web.HTTPBadRequest(text = 'JSON body must be object.')
+            kw = params
+        # form format
+        elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+            params = await request.post()
+            kw = dict(**params)
         else:
-            if self._has_named_kw_arg and (not self._has_var_kw_arg):
-                copy = dict()
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
+            return web.HTTPBadRequest(text = 'Unsupported Content_Type: {}'.format(request.content_type))
+        if not self._has_var_kw_arg:
+            kw = {name: kw[name] for name in self._named_kw_args if name in kw}
+        return kw
+
+    async def __call__(self, request):
+        kw = await self._read_args(request)
+        if isinstance(kw, web.StreamResponse):
+            return kw
+
+        if self._has_path_args:
             for k, v in request.match_info.items():
                 if k in kw:
                     logging.warn('Duplicate arg name in named arg and kw args: {}'.format(k))
                 kw[k] = v
 
+        for name, convert in self._converters.items():
+            if name in kw and kw[name] is not None:
+                try:
+                    kw[name] = convert(kw[name])
+                except (TypeError, ValueError):
+                    return web.HTTPBadRequest(text = 'Invalid argument: {}'.format(name))
+
         if self._has_request_arg:
             kw['request'] = request
 
@@ -148,8 +209,7 @@ class RequestHandler(object):
             for name in self._required_kw_args:
                 if not name in kw:
                     return web.HTTPBadRequest(text = 'Missing argument: {}'.format(name))
-        
-        logging.info('call with args: {}'.format(str(kw)))
+
         try:
             r = await self._func(**kw)
             return r
@@ -2,14 +2,18 @@
 
 __author__ = 'Minty'
 
-from coroweb import get, post
+from coroweb import get, post, cache_page, conditional
 from model import User, Blog, Comment, next_id
 
-from apis import Page, APIError, APIPermissionError, APIValueError, APIResourceNotFoundError
+from apis import Page, decode_cursor, APIError, APIPermissionError, APIValueError, APIResourceNotFoundError
 from aiohttp import web
 
 from config import configs
-import asyncio, time, re, hashlib, json, logging
+from cache import session_cache, page_cache, version_cache
+from search import search_index
+from passwords import hasher, legacy_hash
+import asyncio, time, re, hashlib, hmac, json, logging
+import metrics, orm, serialize
 
 COOKIE_NAME = 'awesession'
 _COOKIE_KEY = configs.session.secret
@@ -32,6 +36,77 @@ def get_page_index(page_str):
         p = 1
     return p
 
+def get_page_cursor(after, before):
+    '''
+    Turn after/before cursor strings into findPage() keyset arguments.
+    '''
+    if after:
+        return dict(after=decode_cursor(after))
+    if before:
+        return dict(before=decode_cursor(before))
+    return dict()
+
+def invalidate_pages(*paths):
+    '''
+    Drop the cached renderings and validated versions of paths, whatever their query string.
+    '''
+    page_cache.evict(lambda key: key.split('?', 1)[0] in paths)
+    version_cache.evict(lambda key: key in paths)
+
+def invalidate_blogs(*ids):
+    '''
+    Drop the cached blog lists, and the cached pages of the blogs ids, html and json alike.
+    '''
+    paths = ['/', '/api/blogs']
+    for id in ids:
+        paths.extend(['/blog/{}'.format(id), '/api/blogs/{}'.format(id)])
+    invalidate_pages(*paths)
+
+async def blogs_version(request):
+    '''
+    Validator of blog lists. Removed blogs only change the count, so there is no last modified time.
+    '''
+    return None, await Blog.findVersion()
+
+async def blog_version(request):
+    '''
+    Validator of a blog and its comments: comments change updated_at of their blog.
+    '''
+    blog = await Blog.find(request.match_info['id'], columns=['updated_at'])
+    if blog is None:
+        return None
+    return blog.updated_at, blog.updated_at
+
+async def search_blogs(q, page_index):
+    '''
+    One page of the blogs matching q, best first.
+    '''
+    total, hits = await search_index.run(search_index.search, q, (page_index - 1) * 10, 10)
+    p = Page(total, page_index)
+    if p.limit == 0:
+        return p, []
+    return p, await Blog.findByIds([pk for pk, score in hits], columns=['name', 'summary', 'created_at'])
+
+async def export_ndjson(request, model, **kw):
+    '''
+    Stream the rows of a model as newline delimited json, writing every batch as it arrives.
+    '''
+    r = web.StreamResponse()
+    r.content_type = 'application/x-ndjson'
+    r.charset = 'utf-8'
+    r.headers['Content-Disposition'] = 'attachment; filename="{}.ndjson"'.format(model.__table__)
+    await r.prepare(request)
+    async for items in model.iterate(orderBy='created_at, id', **kw):
+        lines = []
+        for item in items:
+            if 'password' in item:
+                item.password = '******'
+            lines.append(serialize.dumps(item))
+        lines.append(b'')
+        await r.write(b'\n'.join(lines))
+    await r.write_eof()
+    return r
+
 def user2cookie(user, max_age):
     '''
     Generate cookie str by user.
@@ -59,6 +134,10 @@ async def cookie2user(cookie_str):
         if int(expires) < time.time():
             logging.info('cookie expires')
             return None
+        user = session_cache.get(cookie_str)
+        if user is not None:
+            # hand out a copy so the cached entry cannot be changed by a request
+            return User(**user)
         user = await User.find(uid)
         if user is None:
             return None
@@ -67,32 +146,34 @@ async def cookie2user(cookie_str):
             logging.info('invalid sha1')
             return None
         user.password = '******'
+        session_cache.set(cookie_str, User(**user), int(expires))
         logging.info('finish cookie2user successfully')
         return user
     except Exception as e:
         logging.exception(e)
         return None
 
-async def text2html(text):
-    lines = map(lambda s: '<p>{}</p>'.format(s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')),
-        filter(lambda s: s.strip() != '', text.split('\n')))
-    return ''.join(lines)
-
 @get('/')
-async def index(*, page='1'):
-    page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')
-    page = Page(num)
-    if num == 0:
-        blogs = []
-    else:
-        blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
+@cache_page
+@conditional(blogs_version)
+async def index(*, page='1', after=None, before=None):
+    page, blogs = await Blog.findPage(page_index=get_page_index(page), compact=True, **get_page_cursor(after, before))
     return {
         '__template__': 'blogs.html',
         'blogs': blogs,
         'page': page
     }
 
+@get('/search')
+async def search(*, q='', page='1'):
+    page, blogs = await search_blogs(q, get_page_index(page))
+    return {
+        '__template__': 'search.html',
+        'q': q,
+        'blogs': blogs,
+        'page': page
+    }
+
 @get('/register')
 async def register():
     return {
@@ -114,12 +195,11 @@ async def signout(request):
     return r
 
 @get('/blog/{id}')
+@cache_page
+@conditional(blog_version)
 async def get_blog(id):
     blog = await Blog.find(id)
     comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
-    for c in comments:
-        c.html_content = text2html(c.content)
-    blog.html_content = text2html(blog.content)
     return {
         '__template__': 'blog.html',
         'blog': blog,
@@ -167,12 +247,39 @@ def manage_users(*, page='1'):
         'page_index': get_page_index(page)
     }
 
+def metrics_allowed(request):
+    '''
+    With a token configured, scrapers must send it as a bearer token. Without one, the peer address decides,
+    which a reverse proxy on the same host turns into 127.0.0.1 for every client.
+    '''
+    token = configs.metrics.token
+    if token:
+        return hmac.compare_digest(request.headers.get('Authorization', '').encode('utf-8'), 'Bearer {}'.format(token).encode('utf-8'))
+    return request.remote in configs.metrics.allow
+
+@get('/metrics')
+async def get_metrics(request):
+    if not metrics_allowed(request):
+        return web.HTTPForbidden()
+    return web.Response(body=metrics.render().encode('utf-8'), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
 @get('/api/users')
-async def api_get_users():
-    users = await User.findAll(orderBy = 'created_at desc')
+async def api_get_users(*, page='1', after=None, before=None):
+    p, users = await User.findPage(page_index=get_page_index(page), compact=True, **get_page_cursor(after, before))
     for u in users:
         u.password = '******'
-    return dict(users = users)
+    return dict(page=p, users=users)
+
+# width of users.password in the live database, read once. until sql/schema_script.py migrate widened it
+# from varchar(50), a new hash fails to store in strict mode, or is truncated and locks its user out
+_password_width = None
+
+async def password_width():
+    global _password_width
+    if _password_width is None:
+        rs = await orm.select("select `character_maximum_length` `width` from information_schema.columns where `table_schema`=database() and `table_name`='users' and `column_name`='password'", [])
+        _password_width = rs[0]['width'] if rs else 0
+    return _password_width
 
 @post('/api/users')
 async def api_register_user(*, email, name, password):
@@ -187,12 +294,16 @@ async def api_register_user(*, email, name, password):
     if len(users) > 0 :
         raise APIError('register:failed', 'email', 'Email is already in use.')
     uid = next_id()
-    sha1_password = '{}:{}'.format(uid, password)
+    stored = await hasher.hash(password)
+    if len(stored) > await password_width():
+        # upgraded on a sign-in after the migration
+        logging.warning('users.password is too narrow for new password hashes, run sql/schema_script.py migrate')
+        stored = legacy_hash(uid, password)
     user = User(
         id = uid,
         name = name.strip(),
         email = email,
-        password = hashlib.sha1(sha1_password.encode('utf-8')).hexdigest(),
+        password = stored,
         image = 'http://www.gravatar.com/avatar/{}?d=mm&s=120'.format(hashlib.md5(email.encode('utf-8')).hexdigest())
     )
     await user.save()
@@ -205,7 +316,7 @@ async def api_register_user(*, email, name, password):
     )
     user.password = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii = False).encode('utf-8')
+    r.body = serialize.dumps(user)
     return r
 
 @post('/api/authenticate')
@@ -214,41 +325,54 @@ async def authenticate(*, email, password):
         raise APIValueError('email', 'Invalid email.')
     if not password:
         raise APIValueError('password', 'Invalid password.')
-    users = await User.findAll('email=?', email)
+    users = await User.findAll('email=?', [email])
     if len(users) == 0:
         raise APIValueError('email', 'Email not exist.')
     user = users[0]
-    # verify password
-    sha1 = hashlib.sha1()
-    sha1.update(user.id.encode('utf-8'))
-    sha1.update(b':')
-    sha1.update(password.encode('utf-8'))
-    if sha1.hexdigest() != user.password:
+    # verify password, on the executor of the hasher
+    ok, rehash = await hasher.verify(user.id, password, user.password)
+    if not ok:
         raise APIValueError('password', 'Wrong password.')
+    if rehash:
+        # legacy sha1 or outdated cost: store a current hash while the password is at hand.
+        # the sign-in goes on with the old hash when it cannot be replaced, cookies are signed with the stored one
+        stored = user.password
+        new = await hasher.hash(password)
+        if len(new) > await password_width():
+            logging.warning('users.password is too narrow for new password hashes, run sql/schema_script.py migrate')
+        else:
+            user.password = new
+            try:
+                await user.update()
+            except Exception:
+                logging.exception('failed to store the new password hash of user {}'.format(user.id))
+                user.password = stored
     # create response
     logging.info("****** signin successfully ******")
     r = web.Response()
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.password = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = serialize.dumps(user)
     return r
 
 @get('/api/blogs')
-async def api_blogs(*, page='1'):
-    page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, blogs=())
-    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+@conditional(blogs_version)
+async def api_blogs(*, page='1', after=None, before=None):
+    p, blogs = await Blog.findPage(page_index=get_page_index(page), compact=True, **get_page_cursor(after, before))
     return dict(page=p, blogs=blogs)
 
 @get('/api/blogs/{id}')
+@conditional(blog_version)
 async def api_get_blog(*, id):
     blog = await Blog.find(id)
     return blog
 
+@get('/api/search')
+async def api_search(*, q='', page='1'):
+    p, blogs = await search_blogs(q, get_page_index(page))
+    return dict(page=p, blogs=blogs)
+
 @post('/api/blogs')
 async def api_create_blog(request, *, name, summary, content):
     check_admin(request)    
@@ -267,6 +391,8 @@ async def api_create_blog(request, *, name, summary, content):
         content = content.strip()
     )
     await blog.save()
+    search_index.later(search_index.put, blog)
+    invalidate_blogs()
     return blog
 
 @post('/api/blogs/{id}')
@@ -283,23 +409,22 @@ async def api_update_blog(id, request, *, name, summary, content):
     blog.summary = summary.strip()
     blog.content = content.strip()
     await blog.update()
+    search_index.later(search_index.put, blog)
+    invalidate_blogs(id)
     return blog
 
 @post('/api/blogs/{id}/delete')
 async def api_delete_blog(request, *, id):
     check_admin(request)
-    blog = await Blog.find(id)
+    blog = await Blog.find(id, columns=[])
     await blog.remove()
+    search_index.later(search_index.delete, id)
+    invalidate_blogs(id)
     return dict(id=id)
 
 @get('/api/comments')
-async def api_comments(*, page='1'):
-    page_index = get_page_index(page)
-    num = await Comment.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, comments=())
-    comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+async def api_comments(*, page='1', after=None, before=None):
+    p, comments = await Comment.findPage(page_index=get_page_index(page), compact=True, **get_page_cursor(after, before))
     return dict(page=p, comments=comments)
 
 @post('/api/blogs/{id}/comments')
@@ -309,11 +434,13 @@ async def api_create_comment(id, request, *, content):
         raise APIPermissionError('Please signin first.')
     if not content or not content.strip():
         raise APIValueError('content')
-    blog = await Blog.find(id)
+    blog = await Blog.find(id, columns=[])
     if blog is None:
         raise APIResourceNotFoundError('Blog')
     comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
+    # counted in the blog by the same transaction, see Comment.afterInsert
     await comment.save()
+    invalidate_blogs(blog.id)
     return comment
 
 @post('/api/comments/{id}/delete')
@@ -322,5 +449,23 @@ async def api_delete_comments(id, request):
     c = await Comment.find(id)
     if c is None:
         raise APIResourceNotFoundError('Comment')
-    await c.remove()
-    return dict(id=id)
\ No newline at end of file
+    async with orm.transaction():
+        await c.remove()
+        await Blog.recount([c.blog_id])
+    invalidate_blogs(c.blog_id)
+    return dict(id=id)
+
+@get('/api/export/users')
+async def api_export_users(request):
+    check_admin(request)
+    return await export_ndjson(request, User)
+
+@get('/api/export/blogs')
+async def api_export_blogs(request):
+    check_admin(request)
+    return await export_ndjson(request, Blog, columns=Blog.__fields__)
+
+@get('/api/export/comments')
+async def api_export_comments(request):
+    check_admin(request)
+    return await export_ndjson(request, Comment)
\ No newline at end of file
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+'''
+Convert blog and comment text into html.
+'''
+
+__author__ = 'Minty'
+
+try:
+    import markdown
+except ImportError:
+    markdown = None
+
+def text2html(text):
+    '''
+    Escape plain text and wrap every non-blank line into a paragraph.
+    '''
+    lines = map(lambda s: '<p>{}</p>'.format(s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')),
+        filter(lambda s: s.strip() != '', text.split('\n')))
+    return ''.join(lines)
+
+def markdown2html(text):
+    '''
+    Render markdown into html, fall back to text2html() when the markdown package is not installed.
+    Markdown keeps inline html, so only use it for text written by admins.
+    '''
+    if markdown is None:
+        return text2html(text)
+    return markdown.markdown(text, extensions = ['extra', 'sane_lists'], output_format = 'html5')
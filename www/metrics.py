@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+'''
+Counters, gauges and histograms, rendered in the Prometheus text format.
+'''
+
+__author__ = 'Minty'
+
+import bisect, threading
+
+# seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# every metric created, in creation order
+REGISTRY = []
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra = ()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, escape(v)) for k, v in pairs) + '}'
+
+class Metric(object):
+    '''
+    Base class of metrics: a value per combination of label values.
+    '''
+    type = None
+
+    def __init__(self, name, help, labelnames = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = dict()
+        # metrics may be updated from executor threads
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError('{} expects labels {}, got {}'.format(self.name, self.labelnames, tuple(labels)))
+        return tuple(labels[n] for n in self.labelnames)
+
+    def get(self, **labels):
+        return self._values.get(self.key(labels), 0)
+
+    def samples(self):
+        for key, value in sorted(self._values.items()):
+            yield self.name, format_labels(self.labelnames, key), value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.type)]
+        for name, labels, value in self.samples():
+            lines.append('{}{} {}'.format(name, labels, value))
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount = 1, **labels):
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[self.key(labels)] = value
+
+    def inc(self, amount = 1, **labels):
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount = 1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames = (), buckets = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self._lock:
+            # [count per bucket..., count, sum]
+            data = self._values.get(key, None)
+            if data is None:
+                data = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                data[i] += 1
+            data[-2] += 1
+            data[-1] += value
+
+    def get(self, **labels):
+        ' (count, sum) of observations. '
+        data = self._values.get(self.key(labels), None)
+        if data is None:
+            return 0, 0.0
+        return data[-2], data[-1]
+
+    def samples(self):
+        for key, data in sorted(self._values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, data):
+                cumulative += n
+                yield self.name + '_bucket', format_labels(self.labelnames, key, [('le', bound)]), cumulative
+            yield self.name + '_bucket', format_labels(self.labelnames, key, [('le', '+Inf')]), data[-2]
+            yield self.name + '_count', format_labels(self.labelnames, key), data[-2]
+            yield self.name + '_sum', format_labels(self.labelnames, key), data[-1]
+
+# functions run by render() first, to set gauges of things cheaper to read on demand than to track
+COLLECTORS = []
+
+def collect(fn):
+    ' run fn() before every render(), usable as a decorator. '
+    COLLECTORS.append(fn)
+    return fn
+
+def render():
+    ' all metrics in the Prometheus text exposition format. '
+    for fn in COLLECTORS:
+        fn()
+    return '\n'.join(m.render() for m in REGISTRY) + '\n'
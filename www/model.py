@@ -2,11 +2,13 @@
 
 __author__ = 'Minty'
 
-import time, uuid, asyncio
+import time, uuid, asyncio, logging
 
 import orm
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from cache import session_cache
+from markup import text2html, markdown2html
+from orm import Model, Index, StringField, BooleanField, IntegerField, FloatField, TextField, create_args_string
 
 def next_id():
     return '{:0^15}{}000'.format(
@@ -18,12 +20,21 @@ class User(Model):
     __table__ = 'users'
 
     id = StringField(primary_key = True, default = next_id, ddl = 'varchar(50)')
-    email = StringField(ddl = 'varchar(50)')
-    password = StringField(ddl = 'varchar(50)')
+    email = StringField(ddl = 'varchar(50)', unique = True)
+    # hash of passwords.py, which names its algorithm and cost
+    password = StringField(ddl = 'varchar(200)')
     admin = BooleanField()
     name = StringField(ddl = 'varchar(50)')
     image = StringField(ddl = 'varchar(500)')
-    created_at = FloatField(default = time.time)
+    created_at = FloatField(default = time.time, index = True)
+
+    # cookies are signed with the password, and verified sessions keep the user with its admin flag,
+    # so drop the sessions of a changed user. this reaches the cache of this process only: other workers,
+    # and changes made by SQL outside the app, go on with the old session for up to session.cache_ttl seconds
+    @classmethod
+    def afterChange(cls, pks):
+        pks = set(pks)
+        session_cache.evict(lambda cookie: cookie.split('-', 1)[0] in pks)
 
 class Blog(Model):
     __table__ = 'blogs'
@@ -34,8 +45,61 @@ class Blog(Model):
     user_image = StringField(ddl = 'varchar(500)')
     name = StringField(ddl = 'varchar(50)')
     summary = StringField(ddl = 'varchar(200)')
-    content = TextField()
-    created_at = FloatField(default = time.time)
+    # bodies are only needed on the blog page, lists show name and summary
+    content = TextField(deferred = True)
+    # content rendered on write, so that page views do not render it again
+    html_content = TextField(deferred = True)
+    created_at = FloatField(default = time.time, index = True)
+    # last change of the blog page: edits, and comments. validates cached copies of the page
+    updated_at = FloatField(default = time.time, index = True)
+    # kept by the writes of comments, so that lists need not count them
+    comment_count = IntegerField(derived = True)
+    last_commented_at = FloatField(derived = True, index = True)
+
+    def beforeWrite(self):
+        if 'content' in self:
+            self.html_content = markdown2html(self.content)
+        self.updated_at = time.time()
+
+    @classmethod
+    async def addComments(cls, comments):
+        ' count new comments in their blogs, in the transaction which inserts them. '
+        blogs = dict()
+        for c in comments:
+            number, last = blogs.get(c.blog_id, (0, 0.0))
+            blogs[c.blog_id] = number + 1, max(last, c.created_at)
+        now = time.time()
+        # blogs in a fixed order, so that concurrent transactions do not deadlock on their rows
+        await orm.executemany('update `blogs` set `comment_count`=`comment_count`+?, `last_commented_at`=greatest(`last_commented_at`, ?), `updated_at`=? where `id`=?',
+            [[number, last, now, id] for id, (number, last) in sorted(blogs.items())])
+
+    @classmethod
+    async def recount(cls, ids):
+        ' count the comments of blogs again, after comments were removed, or to repair drift. '
+        comments = 'from `comments` where `blog_id`=`blogs`.`id`'
+        sql = 'update `blogs` set `comment_count`=(select count(`id`) {0}), `last_commented_at`=(select coalesce(max(`created_at`), 0) {0}), `updated_at`=? where `id` in ({1})'
+        return await orm.execute(sql.format(comments, create_args_string(len(ids))), [time.time()] + sorted(ids))
+
+    @classmethod
+    async def reconcile(cls, batch_size = None):
+        '''
+        Compare comment_count and last_commented_at of every blog with its comments, batch by batch,
+        and recount the blogs which drifted. returns the number of blogs repaired.
+        '''
+        repaired = 0
+        after = ''
+        while True:
+            blogs = await cls.findAll('`id`>?', [after], orderBy = '`id`', limit = batch_size or orm.BATCH_SIZE, columns = ['comment_count', 'last_commented_at'])
+            if not blogs:
+                return repaired
+            after = blogs[-1].id
+            rs = await orm.select('select `blog_id`, count(`id`) `number`, max(`created_at`) `last` from `comments` where `blog_id` in ({}) group by `blog_id`'.format(create_args_string(len(blogs))), [b.id for b in blogs])
+            actual = {r['blog_id']: (r['number'], r['last']) for r in rs}
+            drifted = [b.id for b in blogs if (b.comment_count, b.last_commented_at) != actual.get(b.id, (0, 0.0))]
+            if drifted:
+                logging.warning('recount comments of {} blogs: {}'.format(len(drifted), ', '.join(drifted)))
+                await cls.recount(drifted)
+                repaired += len(drifted)
 
 class Comment(Model):
     __table__ = 'comments'
@@ -46,7 +110,22 @@ class Comment(Model):
     user_name = StringField(ddl = 'varchar(50)')
     user_image = StringField(ddl = 'varchar(500)')
     content = TextField()
-    created_at = FloatField(default = time.time)
+    # comments come from any user, so they are escaped instead of rendered as markdown
+    html_content = TextField()
+    created_at = FloatField(default = time.time, index = True)
+
+    # comments of a blog page, newest first
+    __indexes__ = [Index('blog_id', 'created_at')]
+    # a busy blog takes many comments at once, written together by one insert
+    __batch_inserts__ = True
+
+    @classmethod
+    async def afterInsert(cls, comments):
+        await Blog.addComments(comments)
+
+    def beforeWrite(self):
+        if 'content' in self:
+            self.html_content = text2html(self.content)
 
 if __name__ == '__main__':
 
@@ -2,18 +2,107 @@
 
 __author__ = 'Minty'
 
-import asyncio, logging, aiomysql
+import asyncio, contextlib, contextvars, logging, math, re, time, aiomysql
+
+import serialize
+from apis import Page
+from metrics import Counter, Gauge, Histogram, collect
 
 # logging.info() will make no use without this config
 logging.basicConfig(level = logging.INFO)
 
 def log(sql, args = ()):
-    logging.info('SQL: {}'.format(sql))
+    logging.debug('SQL: {}'.format(sql))
 
-async def create_pool(loop, **kw):
-    logging.info('  create database connection pool ...')
-    global __pool
-    __pool = await aiomysql.create_pool(
+# statement metrics, switched by create_pool(instrument = True)
+_instrument = False
+# seconds, statements running longer are logged with the types of their arguments
+_slow_query = None
+
+sql_seconds = Histogram('sql_statement_seconds', 'Time spent on a SQL statement, including connection acquire.', ['statement'])
+sql_rows = Counter('sql_statement_rows_total', 'Rows returned or affected by a SQL statement.', ['statement'])
+sql_errors = Counter('sql_statement_errors_total', 'SQL statements which raised an error.', ['statement'])
+pool_connections = Gauge('db_pool_connections', 'Connections of a pool, by state.', ['pool', 'state'])
+pool_waiting = Gauge('db_pool_waiting', 'Callers waiting for a connection of a pool.', ['pool'])
+pool_acquire_seconds = Histogram('db_pool_acquire_seconds', 'Time waited for a connection of a pool.', ['pool'])
+batch_rows = Histogram('db_batch_insert_rows', 'Rows written by one grouped insert.', ['table'], buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500))
+
+_RE_ARGS_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_RE_SPACES = re.compile(r'\s+')
+
+def normalize(sql):
+    ' one label per statement shape: placeholder lists like in (?, ?, ?) collapse into (...). '
+    return _RE_SPACES.sub(' ', _RE_ARGS_LIST.sub('(...)', sql)).strip()
+
+def args_shape(args):
+    ' types of the arguments, never their values. '
+    if not args:
+        return '()'
+    if isinstance(args[0], (list, tuple)):
+        return '{} x {}'.format(len(args), args_shape(args[0]))
+    return '({})'.format(', '.join(type(a).__name__ for a in args))
+
+def _started():
+    if _instrument or _slow_query is not None:
+        return time.perf_counter()
+    return None
+
+def _record(sql, args, started, rows = None, error = False):
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    statement = normalize(sql)
+    if _instrument:
+        sql_seconds.observe(elapsed, statement = statement)
+        if rows is not None:
+            sql_rows.inc(rows, statement = statement)
+        if error:
+            sql_errors.inc(statement = statement)
+    if _slow_query is not None and elapsed >= _slow_query:
+        logging.warning('slow query ({:.3f}s): {} args: {}'.format(elapsed, statement, args_shape(args)))
+
+class Replica(object):
+    '''
+    Pool of a read replica, taken out of rotation while it fails health checks.
+    '''
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.healthy = True
+
+    async def check(self):
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.ping(reconnect = False)
+            if not self.healthy:
+                logging.info('  replica {} is back'.format(self.name))
+            self.healthy = True
+        except Exception as e:
+            self.mark_failed(e)
+
+    def mark_failed(self, e):
+        if self.healthy:
+            logging.warning('  replica {} failed: {}'.format(self.name, e))
+        self.healthy = False
+
+# primary pool takes all writes, replica pools share the reads
+__pool = None
+__replicas = []
+__next_replica = 0
+__health_task = None
+# seconds a task keeps reading from the primary after it wrote
+_read_your_writes = 5
+# seconds to wait for a free connection before giving up, None to wait for ever
+_acquire_timeout = None
+# connections idle for longer are pinged before use: the server or a firewall may have dropped them
+_ping_after = None
+# time until which the current task (request) reads from the primary
+_primary_until = contextvars.ContextVar('primary_until', default = 0)
+# connection of the transaction() the current task is in
+_transaction = contextvars.ContextVar('transaction', default = None)
+
+async def _create(loop, kw):
+    return await aiomysql.create_pool(
         host = kw.get('host', 'localhost'),
         port = kw.get('port', 3306),
         user = kw['user'],
@@ -24,54 +113,403 @@ async def create_pool(loop, **kw):
         # True means autocommit after database is changed
         autocommit = kw.get('autocommit', True),
         maxsize = kw.get('maxsize', 10),
-        minsize = kw.get('minsize', 1),
+        # connections opened before create_pool() returns, so the first requests do not pay for them
+        minsize = min(kw.get('minsize', 1), kw.get('maxsize', 10)),
+        # seconds after which a connection is closed and opened again on release, -1 to keep it
+        pool_recycle = kw.get('pool_recycle', -1),
         loop = loop
     )
 
+async def create_pool(loop, **kw):
+    logging.info('  create database connection pool ...')
+    global __pool, __replicas, __health_task, _instrument, _slow_query, _read_your_writes, _acquire_timeout, _ping_after, _batch_delay, _batch_rows
+    _instrument = kw.get('instrument', False)
+    _slow_query = kw.get('slow_query', None)
+    _read_your_writes = kw.get('read_your_writes', 5)
+    _acquire_timeout = kw.get('acquire_timeout', None)
+    _ping_after = kw.get('ping_after', None)
+    _batch_delay = kw.get('batch_delay', None)
+    _batch_rows = kw.get('batch_rows', 100)
+    __pool = await _create(loop, kw)
+    __pool.name = 'primary'
+    logging.info('  database pool ready with {} connections'.format(__pool.size))
+    __replicas = []
+    # replicas inherit every setting of the primary they do not override
+    for r in kw.get('replicas', ()):
+        options = dict(kw, **r)
+        name = '{}:{}'.format(options.get('host', 'localhost'), options.get('port', 3306))
+        logging.info('  create replica connection pool {} ...'.format(name))
+        pool = await _create(loop, options)
+        pool.name = name
+        __replicas.append(Replica(name, pool))
+    if __replicas:
+        __health_task = asyncio.ensure_future(_check_replicas(kw.get('replica_check', 5)), loop = loop)
+
+async def _check_replicas(interval):
+    while True:
+        await asyncio.sleep(interval)
+        await asyncio.gather(*[r.check() for r in __replicas])
+
 async def destroy_pool():
     logging.info('  close database connection pool ...')
-    global __pool
-    if __pool is not None:
-        __pool.close()
-        await __pool.wait_closed()
+    global __pool, __replicas, __health_task
+    # rows waiting in batches still need the pool
+    for batcher in list(_batchers.values()):
+        await batcher.close()
+    _batchers.clear()
+    if __health_task is not None:
+        __health_task.cancel()
+        __health_task = None
+    for p in [__pool] + [r.pool for r in __replicas]:
+        if p is not None:
+            p.close()
+            await p.wait_closed()
+    __pool = None
+    __replicas = []
 
-async def select(sql, args, size = None):
-    log(sql, args)
-    global __pool
-    # equals await type(__pool.acquire).__aenter
-    # connect database
-    async with __pool.acquire() as conn:
-        #Obtain cursor. DictCursor: a cursor which returns results as a dictionary. 
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            #execute(query, args=None): sql statement and tuple or list of arguments for sql query
-            logging.info(sql.replace('?', '%s'))
-            await cur.execute(sql.replace('?', '%s'), args or ())
-            if size:
-                rs = await cur.fetchmany(size)
+def use_primary(seconds = None):
+    ' make the current task read from the primary for seconds, so it sees its own writes. '
+    _primary_until.set(time.time() + (_read_your_writes if seconds is None else seconds))
+
+def reading_primary():
+    ' True while the current task reads from the primary after a write, or is in a transaction. '
+    return _transaction.get() is not None or _primary_until.get() > time.time()
+
+@contextlib.asynccontextmanager
+async def transaction():
+    '''
+    async with transaction(): statements of the block run on one connection of the primary,
+    and are committed together at the end, or rolled back when the block raises.
+    A block inside another one is part of the outer transaction.
+    '''
+    if _transaction.get() is not None:
+        yield
+        return
+    async with acquire(__pool) as conn:
+        await conn.begin()
+        token = _transaction.set(conn)
+        try:
+            yield
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            raise
+        finally:
+            _transaction.reset(token)
+
+def _read_replica():
+    ' next healthy replica by round robin, None when reads must go to the primary. '
+    global __next_replica
+    if not __replicas or reading_primary():
+        return None
+    for i in range(len(__replicas)):
+        r = __replicas[(__next_replica + i) % len(__replicas)]
+        if r.healthy:
+            __next_replica = (__next_replica + i + 1) % len(__replicas)
+            return r
+    return None
+
+# moving average of the time callers waited for a connection. each wait weighs ALPHA,
+# and the average fades with a time constant of WAIT_DECAY seconds when nobody acquires
+ALPHA = 0.2
+WAIT_DECAY = 1.0
+_wait_avg = 0.0
+_wait_at = 0.0
+# acquire() => start of its wait, of the callers waiting now, oldest first
+_waiters = dict()
+
+@collect
+def _collect_pools():
+    for pool in [__pool] + [r.pool for r in __replicas]:
+        if pool is not None:
+            pool_connections.set(pool.size - pool.freesize, pool = pool.name, state = 'in_use')
+            pool_connections.set(pool.freesize, pool = pool.name, state = 'free')
+
+class PoolTimeout(asyncio.TimeoutError):
+    ' no connection of a pool became free within the acquire timeout. '
+    pass
+
+def _average_wait(now):
+    return _wait_avg * math.exp(-(now - _wait_at) / WAIT_DECAY)
+
+def pool_wait():
+    '''
+    Recent seconds callers waited for a database connection. admission control sheds load on it.
+    The average only moves when a wait ends, so the wait of the oldest caller still waiting counts too:
+    when every connection is stuck, nothing ends, but that wait keeps growing.
+    '''
+    now = time.monotonic()
+    if _waiters:
+        return max(_average_wait(now), now - next(iter(_waiters.values())))
+    return _average_wait(now)
+
+class acquire(object):
+    '''
+    async with acquire(pool) as conn: like pool.acquire(), with a timeout, a ping of connections idle for long,
+    and keeping track of the time waited for the connection.
+    '''
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = None
+
+    async def __aenter__(self):
+        global _wait_avg, _wait_at
+        # statements in a transaction() share its connection
+        if _transaction.get() is not None:
+            return _transaction.get()
+        pool = self._pool
+        started = time.monotonic()
+        pool_waiting.inc(pool = pool.name)
+        _waiters[self] = started
+        try:
+            if _acquire_timeout:
+                conn = await asyncio.wait_for(pool.acquire(), _acquire_timeout)
             else:
-                rs = await cur.fetchall()
-            logging.info('rows returned: {}'.format(len(rs)))
-            logging.info(rs)
-            return rs
+                conn = await pool.acquire()
+        except asyncio.TimeoutError:
+            raise PoolTimeout('no connection of pool {} free after {}s'.format(pool.name, _acquire_timeout))
+        finally:
+            pool_waiting.dec(pool = pool.name)
+            del _waiters[self]
+        now = time.monotonic()
+        pool_acquire_seconds.observe(now - started, pool = pool.name)
+        _wait_avg = _average_wait(now) * (1 - ALPHA) + (now - started) * ALPHA
+        _wait_at = now
+        if _ping_after is not None and now - getattr(conn, 'released_at', now) > _ping_after:
+            try:
+                await conn.ping(reconnect = True)
+            except BaseException:
+                await pool.release(conn)
+                raise
+        self._conn = conn
+        return conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        conn.released_at = time.monotonic()
+        await self._pool.release(conn)
+
+# rows as dicts, or (column names, rows as tuples) when tuples is True
+# mysql client errors of a lost server: cannot connect, server has gone away, lost connection during query
+CONNECTION_ERRORS = (2003, 2006, 2013)
+
+def connection_lost(e):
+    ' whether e tells that the server could not be reached, rather than that the statement failed. '
+    if isinstance(e, PoolTimeout):
+        # a busy pool is not a lost server. PoolTimeout is an OSError since python 3.11
+        return False
+    if isinstance(e, aiomysql.OperationalError):
+        return bool(e.args) and e.args[0] in CONNECTION_ERRORS
+    return isinstance(e, OSError)
+
+async def select(sql, args, size = None, tuples = False):
+    replica = _read_replica()
+    if replica is not None:
+        try:
+            return await _select(replica.pool, sql, args, size, tuples)
+        except (aiomysql.OperationalError, OSError) as e:
+            # a statement failing on its own (unknown column, lock wait, time limit) would fail on the primary too
+            if not connection_lost(e):
+                raise
+            # lost the replica: take it out of rotation and read from the primary
+            replica.mark_failed(e)
+    return await _select(__pool, sql, args, size, tuples)
+
+async def _select(pool, sql, args, size = None, tuples = False):
+    log(sql, args)
+    started = _started()
+    try:
+        # equals await type(pool.acquire).__aenter
+        # connect database
+        async with acquire(pool) as conn:
+            #Obtain cursor. DictCursor: a cursor which returns results as a dictionary. 
+            async with conn.cursor(aiomysql.Cursor if tuples else aiomysql.DictCursor) as cur:
+                #execute(query, args=None): sql statement and tuple or list of arguments for sql query
+                await cur.execute(sql.replace('?', '%s'), args or ())
+                if size:
+                    rs = await cur.fetchmany(size)
+                else:
+                    rs = await cur.fetchall()
+                names = tuple(d[0] for d in cur.description or ())
+    except BaseException:
+        _record(sql, args, started, error = True)
+        raise
+    _record(sql, args, started, len(rs))
+    logging.debug('rows returned: {}'.format(len(rs)))
+    if tuples:
+        return names, rs
+    return rs
+
+# select with an unbuffered server-side cursor, yields lists of at most size rows as they arrive
+async def iterselect(sql, args, size = 1000):
+    log(sql, args)
+    replica = _read_replica()
+    pool = __pool if replica is None else replica.pool
+    started = _started()
+    rows = 0
+    try:
+        async with acquire(pool) as conn:
+            # SSDictCursor does not read the whole result into memory
+            async with conn.cursor(aiomysql.SSDictCursor) as cur:
+                await cur.execute(sql.replace('?', '%s'), args or ())
+                while True:
+                    rs = await cur.fetchmany(size)
+                    if not rs:
+                        break
+                    rows += len(rs)
+                    yield rs
+    except GeneratorExit:
+        # the caller stopped iterating early
+        _record(sql, args, started, rows)
+        raise
+    except BaseException:
+        _record(sql, args, started, rows, error = True)
+        raise
+    _record(sql, args, started, rows)
 
 #includes all INSERT, UPDATE and DELETE
 async def execute(sql, args, autocommit = True):
     log(sql, args)
-    async with __pool.acquire() as conn:
-        if not autocommit:
-            await conn.begin()
-        try:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args or ())
-                # rowcount: Returns the number of rows that has been produced of affected.
-                affected = cur.rowcount
+    # in a transaction() the statement commits with the others
+    autocommit = autocommit or _transaction.get() is not None
+    started = _started()
+    try:
+        async with acquire(__pool) as conn:
             if not autocommit:
-                await conn.commit()
-        except BaseException as e:
+                await conn.begin()
+            try:
+                async with conn.cursor(aiomysql.DictCursor) as cur:
+                    await cur.execute(sql.replace('?', '%s'), args or ())
+                    # rowcount: Returns the number of rows that has been produced of affected.
+                    affected = cur.rowcount
+                if not autocommit:
+                    await conn.commit()
+            except BaseException as e:
+                if not autocommit:
+                    await conn.rollback()
+                raise
+    except BaseException:
+        _record(sql, args, started, error = True)
+        raise
+    _record(sql, args, started, affected)
+    use_primary()
+    return affected
+
+# run one INSERT, UPDATE or DELETE for every args in seq_of_args on one connection.
+# pymysql rewrites a plain 'insert ... values (...)' into multi-row inserts
+async def executemany(sql, seq_of_args, autocommit = True):
+    log(sql)
+    autocommit = autocommit or _transaction.get() is not None
+    started = _started()
+    try:
+        async with acquire(__pool) as conn:
             if not autocommit:
-                await conn.rollback()
+                await conn.begin()
+            try:
+                async with conn.cursor(aiomysql.DictCursor) as cur:
+                    await cur.executemany(sql.replace('?', '%s'), seq_of_args)
+                    affected = cur.rowcount
+                if not autocommit:
+                    await conn.commit()
+            except BaseException as e:
+                if not autocommit:
+                    await conn.rollback()
+                raise
+    except BaseException:
+        _record(sql, seq_of_args, started, error = True)
+        raise
+    _record(sql, seq_of_args, started, affected)
+    use_primary()
+    return affected
+
+# rows or keys handled by one statement of the bulk operations
+BATCH_SIZE = 1000
+
+def chunks(L, size = None):
+    size = size or BATCH_SIZE
+    for i in range(0, len(L), size):
+        yield L[i : i + size]
+
+# seconds inserts of models with __batch_inserts__ wait for others to share their transaction, None to write them at once
+_batch_delay = None
+# rows written at once, a full batch does not wait
+_batch_rows = 100
+# model => InsertBatcher
+_batchers = dict()
+
+class InsertBatcher(object):
+    '''
+    Group commit of the inserts of a model: rows collected for up to delay seconds, or until there are max_rows,
+    are written by one multi-row insert in one transaction. Every caller waits for the outcome of its own row.
+    '''
+    def __init__(self, model, delay, max_rows):
+        self.model = model
+        self.delay = delay
+        self.max_rows = max_rows
+        # (object, future) waiting for the next flush
+        self._rows = []
+        self._timer = None
+        # tasks writing flushed rows
+        self._writes = set()
+
+    async def insert(self, obj):
+        ' insert one object, returns the affected rows like execute(). '
+        fut = asyncio.get_event_loop().create_future()
+        self._rows.append((obj, fut))
+        if len(self._rows) >= self.max_rows:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.delay, self.flush)
+        # a cancelled caller only stops waiting, its row is written with the others
+        rows = await asyncio.shield(fut)
+        # the write ran in a task of its own: make the caller read its own write too
+        use_primary()
+        return rows
+
+    def flush(self):
+        ' write the rows collected so far, without waiting for the delay. '
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        rows, self._rows = self._rows, []
+        if rows:
+            task = asyncio.ensure_future(self._write(rows))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    async def close(self):
+        ' write the rows collected so far, and wait for every write. '
+        self.flush()
+        if self._writes:
+            await asyncio.wait(list(self._writes))
+
+    async def _write(self, rows):
+        # the task copied the context of the caller which filled the batch, but not its transaction
+        _transaction.set(None)
+        try:
+            await self.model.insertRows([obj for obj, fut in rows])
+            batch_rows.observe(len(rows), table = self.model.__table__)
+        except Exception as e:
+            if len(rows) == 1:
+                rows[0][1].set_exception(e)
+                return
+            # the transaction was rolled back: write the rows one by one,
+            # so that a bad row (a duplicate key) fails its own caller only
+            logging.warning('grouped insert into {} of {} rows failed, inserting them one by one: {}'.format(self.model.__table__, len(rows), e))
+            for obj, fut in rows:
+                try:
+                    fut.set_result(await self.model.insertRows([obj]))
+                except Exception as e:
+                    fut.set_exception(e)
+            return
+        except BaseException:
+            for obj, fut in rows:
+                fut.cancel()
             raise
-        return affected
+        for obj, fut in rows:
+            fut.set_result(1)
 
 # create a string filled with placeholders
 def create_args_string(num):
@@ -81,13 +519,32 @@ def create_args_string(num):
     return ', '.join(L)
 
 # base class to save column type and name
+class Index(object):
+    '''
+    Index of a model, declared by index = True or unique = True on a field,
+    or in the __indexes__ list of the model for several columns: Index('blog_id', 'created_at').
+    '''
+    def __init__(self, *columns, unique = False, name = None):
+        self.columns = columns
+        self.unique = unique
+        self.name = name or 'idx_{}'.format('_'.join(columns))
+
+    def __str__(self):
+        return '<{}{}: {}>'.format('Unique' if self.unique else '', self.__class__.__name__, ', '.join(self.columns))
+
 class Field(object):
 
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, deferred = False, index = False, unique = False, derived = False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        # deferred columns are left out of findAll() unless asked for
+        self.deferred = deferred
+        self.index = index or unique
+        self.unique = unique
+        # derived columns (counters) are kept up to date by SQL of their own, update() never writes them back
+        self.derived = derived
 
     def __str__(self):
         return '<{}, {}: {}>'.format(self.__class__.__name__, self.column_type, self.name)
@@ -95,29 +552,75 @@ class Field(object):
 # belows are several specific column types
 class StringField(Field):
 
-    def __init__(self, name = None, primary_key = False, default = None, ddl = 'varchar(100)'):
-        super().__init__(name, ddl, primary_key, default)
+    def __init__(self, name = None, primary_key = False, default = None, ddl = 'varchar(100)', index = False, unique = False):
+        super().__init__(name, ddl, primary_key, default, index = index, unique = unique)
 
 class BooleanField(Field):
 
-    def __init__(self, name = None, default = False):
-        super().__init__(name, 'boolean', False, default)
+    def __init__(self, name = None, default = False, index = False):
+        super().__init__(name, 'boolean', False, default, index = index)
 
 
 class IntegerField(Field):
 
-    def __init__(self, name = None, primary_key = False, default = 0):
-        super().__init__(name, 'bigint', primary_key, default)
+    def __init__(self, name = None, primary_key = False, default = 0, index = False, unique = False, derived = False):
+        super().__init__(name, 'bigint', primary_key, default, index = index, unique = unique, derived = derived)
 
 class FloatField(Field):
 
-    def __init__(self, name = None, primary_key = False, default = 0.0):
-        super().__init__(name, 'real', primary_key, default)
+    def __init__(self, name = None, primary_key = False, default = 0.0, index = False, unique = False, derived = False):
+        super().__init__(name, 'real', primary_key, default, index = index, unique = unique, derived = derived)
 
+# text columns cannot be indexed without a prefix length, so they take no index argument
 class TextField(Field):
 
-    def __init__(self, name = None, default = None):
-        super().__init__(name, 'text', False, default)
+    def __init__(self, name = None, default = None, deferred = False, ddl = 'mediumtext'):
+        super().__init__(name, ddl, False, default, deferred)
+
+class Row(object):
+    '''
+    Compact row of a model, with its columns in __slots__ instead of a dict.
+    ModelMetaclass makes one row class per model, see findAll(compact = True).
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def build(cls, names, rs):
+        ' rows from cursor tuples whose columns are names. '
+        new = object.__new__
+        setters = [getattr(cls, n).__set__ for n in names]
+        rows = []
+        for values in rs:
+            row = new(cls)
+            for setter, value in zip(setters, values):
+                setter(row, value)
+            rows.append(row)
+        return rows
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def get(self, key, default = None):
+        return getattr(self, key, default)
+
+    def asdict(self):
+        ' loaded columns as a dict. '
+        d = dict()
+        for n in self.__slots__:
+            try:
+                d[n] = getattr(self, n)
+            except AttributeError:
+                pass
+        return d
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self.asdict())
 
 class ModelMetaclass(type):
 
@@ -141,6 +644,13 @@ class ModelMetaclass(type):
                     fields.append(k)
         if not primarykey:
             raise Exception('Primary key not found.')
+        # indexes of fields first, then the ones declared on the model
+        indexes = [Index(k, unique = v.unique) for k, v in mappings.items() if v.index and not v.primary_key]
+        indexes.extend(attrs.get('__indexes__', []))
+        for index in indexes:
+            for c in index.columns:
+                if c not in mappings:
+                    raise Exception('Invalid column of index {}: {}'.format(index.name, c))
         for k in mappings.keys():
             attrs.pop(k)
         escaped_fields = list(map(lambda f: '`{}`'.format(f), fields))
@@ -148,15 +658,26 @@ class ModelMetaclass(type):
         attrs['__table__'] = tableName
         attrs['__primary_key__'] = primarykey
         attrs['__fields__'] = fields
+        attrs['__deferred__'] = [f for f in fields if mappings[f].deferred]
+        attrs['__derived__'] = [f for f in fields if mappings[f].derived]
+        attrs['__indexes__'] = indexes
         # four different operations. `` to avoid keyword conflicts
         attrs['__select__'] = 'select `{}`, {} from `{}`'.format(primarykey, ', '.join(escaped_fields), tableName)
         attrs['__insert__'] = 'insert into `{}` ({}, `{}`) values ({})'.format(tableName, ', '.join(escaped_fields), primarykey, create_args_string(len(escaped_fields) + 1))
         attrs['__update__'] = 'update `{}` set {} where `{}`=?'.format(tableName, ', '.join(map(lambda f:'`{}`=?'.format(mappings.get(f).name or f), fields)), primarykey)
         attrs['__delete__'] = 'delete from `{}` where `{}`=?'.format(tableName, primarykey)
-        return type.__new__(cls, name, bases, attrs)
+        model = type.__new__(cls, name, bases, attrs)
+        model.__row__ = type('{}Row'.format(name), (Row, ), dict(__slots__ = tuple([primarykey] + fields), __model__ = model))
+        serialize.register(model.__row__, model.__row__.asdict)
+        return model
 
 class Model(dict, metaclass = ModelMetaclass):
 
+    # True for models whose save() may share a transaction with the inserts of other requests, see InsertBatcher
+    __batch_inserts__ = False
+    # async classmethod afterInsert(cls, objs) of a model runs in the transaction which inserts objs
+    afterInsert = None
+
     def __init__(self, **kw):
         # super(type, self) by default
         super().__init__(**kw)
@@ -165,6 +686,8 @@ class Model(dict, metaclass = ModelMetaclass):
         try:
             return self[key]
         except KeyError:
+            if key in self.__deferred__:
+                raise AttributeError('"{}" is deferred and was not loaded, await load() first'.format(key))
             raise AttributeError('"Model" object has no attribute "{}"'.format(key))
 
     def __setattr__(self, key, value):
@@ -183,17 +706,53 @@ class Model(dict, metaclass = ModelMetaclass):
                 setattr(self, key, value)
         return value
 
-    # make one method the class method
     @classmethod
-    async def findAll(cls, where = None, args = None, **kw):
-        ' find objects by where clause.'
-        sql = [cls.__select__]
+    def selectSQL(cls, where = None, args = None, **kw):
+        ' build the select statement of findAll() and its arguments. '
+        # projection: the given columns, or every column which is not deferred. primary key is always loaded
+        columns = kw.get('columns', None)
+        if columns is None:
+            columns = [f for f in cls.__fields__ if f not in cls.__deferred__]
+        for f in columns:
+            if f not in cls.__mappings__:
+                raise ValueError('Invalid column: {}'.format(f))
+        columns = ['`{}`'.format(cls.__primary_key__)] + ['`{}`'.format(f) for f in columns if f != cls.__primary_key__]
+        # a single argument may be given bare, like findAll('email=?', email)
+        if args is None:
+            args = []
+        elif not isinstance(args, (list, tuple)):
+            args = [args]
+        args = list(args)
+        if kw.get('total', False):
+            # uncorrelated subquery: MySQL counts once and repeats the number on every row
+            total = 'select count(`{}`) from `{}`'.format(cls.__primary_key__, cls.__table__)
+            if where:
+                total = '{} where {}'.format(total, where)
+            columns.append('({}) `_total_`'.format(total))
+            args = args + args
+        sql = ['select {} from `{}`'.format(', '.join(columns), cls.__table__)]
         if where:
             sql.append('where')
             sql.append(where)
-        if args is None:
-            args = []
         orderBy = kw.get('orderBy', None)
+        # keyset (cursor) pagination: seek past (created_at, id) instead of skipping rows by offset
+        after = kw.get('after', None)
+        before = kw.get('before', None)
+        if after and before:
+            raise ValueError('Cannot seek both after and before a cursor.')
+        if after or before:
+            column, pk = kw.get('keyset', ('created_at', cls.__primary_key__))
+            value, key = after or before
+            op = '<' if after else '>'
+            seek = '(`{0}` {2} ? or (`{0}` = ? and `{1}` {2} ?))'.format(column, pk, op)
+            if where:
+                sql[-1] = '({}) and {}'.format(where, seek)
+            else:
+                sql.append('where')
+                sql.append(seek)
+            args.extend([value, value, key])
+            # rows before the cursor are fetched in ascending order, then reversed by findAll()
+            orderBy = '`{0}` {2}, `{1}` {2}'.format(column, pk, 'desc' if after else 'asc')
         if orderBy:
             sql.append('order by')
             sql.append(orderBy)
@@ -209,10 +768,71 @@ class Model(dict, metaclass = ModelMetaclass):
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: {}'.format(str(limit)))
-        logging.info(' '.join(sql))
-        rs = await select(' '.join(sql), args)
+        return ' '.join(sql), args
+
+    # make one method the class method
+    @classmethod
+    async def findAll(cls, where = None, args = None, **kw):
+        ' find objects by where clause.'
+        sql, args = cls.selectSQL(where, args, **kw)
+        if kw.get('compact', False):
+            # read-only listings: slots rows built from cursor tuples, no dict per row
+            names, rs = await select(sql, args, tuples = True)
+            if kw.get('before', None):
+                rs = rs[::-1]
+            return cls.__row__.build(names, rs)
+        rs = await select(sql, args)
+        if kw.get('before', None):
+            rs = rs[::-1]
         return [cls(**r) for r in rs]
 
+    @classmethod
+    async def iterate(cls, where = None, args = None, batch_size = 1000, **kw):
+        ' iterate objects found by where clause in lists of batch_size, without loading all of them at once. '
+        sql, args = cls.selectSQL(where, args, **kw)
+        async for rs in iterselect(sql, args, batch_size):
+            yield [cls(**r) for r in rs]
+
+    @classmethod
+    async def findPage(cls, where = None, args = None, page_index = 1, page_size = 10, orderBy = 'created_at desc, id desc', **kw):
+        ' find one page of objects and the total count in one query. returns (Page, objects). '
+        after = kw.get('after', None)
+        before = kw.get('before', None)
+        if after or before:
+            limit = page_size
+        else:
+            limit = (page_size * (page_index - 1), page_size)
+        columns = kw.get('columns', None)
+        if columns is not None and 'created_at' not in columns:
+            # page cursors are made of (created_at, id)
+            columns = list(columns) + ['created_at']
+        sql, sql_args = cls.selectSQL(where, args, total = True, orderBy = orderBy, limit = limit, after = after, before = before, columns = columns)
+        compact = kw.get('compact', False)
+        if compact:
+            names, rs = await select(sql, sql_args, tuples = True)
+        else:
+            rs = await select(sql, sql_args)
+        if before:
+            rs = rs[::-1]
+        if rs:
+            # _total_ is the last column
+            num = rs[0][-1] if compact else rs[0]['_total_']
+        else:
+            # no row to carry the count: empty table or page out of range
+            num = await cls.findNumber('count(`{}`)'.format(cls.__primary_key__), where, args)
+        page = Page(num, page_index, page_size)
+        if page.limit == 0:
+            return page, []
+        if compact:
+            items = cls.__row__.build(names[: -1], rs)
+        else:
+            items = []
+            for r in rs:
+                del r['_total_']
+                items.append(cls(**r))
+        page.set_cursors(items)
+        return page, items
+
     @classmethod
     async def findNumber(cls, selectField, where = None, args = None):
         ' find number by select and where. '
@@ -226,33 +846,172 @@ class Model(dict, metaclass = ModelMetaclass):
         return rs[0]['_num_']
 
     @classmethod
-    async def find(cls, pk):
-        ' find object by primary key. '
-        rs = await select('{} where `{}`=?'.format(cls.__select__, cls.__primary_key__), [pk], 1)
+    async def findVersion(cls, where = None, args = None, field = 'updated_at'):
+        ' (number, latest field value) of rows matched by where, which changes when rows are added, changed or removed. '
+        sql = ['select count(`{}`) _num_, max(`{}`) _last_ from `{}`'.format(cls.__primary_key__, field, cls.__table__)]
+        if where:
+            sql.append('where')
+            sql.append(where)
+        rs = await select(' '.join(sql), args, 1)
+        if len(rs) == 0:
+            return 0, None
+        return rs[0]['_num_'], rs[0]['_last_']
+
+    @classmethod
+    async def find(cls, pk, columns = None):
+        ' find object by primary key. loads every column unless columns is given. '
+        if columns is None:
+            sql = cls.__select__
+        else:
+            sql, _ = cls.selectSQL(columns = columns)
+        rs = await select('{} where `{}`=?'.format(sql, cls.__primary_key__), [pk], 1)
         if len(rs) == 0:
             return None
         # ** is a shortcut that allows you to pass multiple arguments to a function directly using either a list/tuple or a dictionary. 
         return cls(**rs[0])
 
-    async def save(self):
+    async def load(self, *fields):
+        ' load columns left out when the object was found, all missing deferred columns by default. '
+        fields = fields or [f for f in self.__deferred__ if f not in self]
+        if not fields:
+            return self
+        sql = 'select {} from `{}` where `{}`=?'.format(', '.join(map(lambda f: '`{}`'.format(f), fields)), self.__table__, self.__primary_key__)
+        rs = await select(sql, [self.getValue(self.__primary_key__)], 1)
+        if len(rs) == 0:
+            raise ValueError('Record not found: {}'.format(self.getValue(self.__primary_key__)))
+        # Model.update shadows dict.update
+        dict.update(self, rs[0])
+        return self
+
+    @classmethod
+    async def findByIds(cls, ids, columns = None):
+        ' find objects by primary keys, in the order of ids. missing keys are skipped. loads every column unless columns is given. '
+        ids = list(ids)
+        found = dict()
+        if columns is None:
+            select_sql = cls.__select__
+        else:
+            select_sql, _ = cls.selectSQL(columns = columns)
+        for chunk in chunks(ids):
+            sql = '{} where `{}` in ({})'.format(select_sql, cls.__primary_key__, create_args_string(len(chunk)))
+            for r in await select(sql, chunk):
+                found[r[cls.__primary_key__]] = cls(**r)
+        return [found[pk] for pk in ids if pk in found]
+
+    # hooks for subclasses
+    def beforeWrite(self):
+        ' called before the object is inserted or updated. '
+        pass
+
+    @classmethod
+    def afterChange(cls, pks):
+        ' called after existing rows were updated or removed. '
+        pass
+
+    def insertArgs(self):
+        ' arguments of __insert__ for this object. '
+        self.beforeWrite()
         args = list(map(self.getValueOrDefault, self.__fields__))
         args.append(self.getValueOrDefault(self.__primary_key__))
-        rows = await execute(self.__insert__, args)
+        return args
+
+    @classmethod
+    async def insertRows(cls, objs):
+        ' insert objects with one statement, in one transaction with afterInsert() if the model has one. '
+        L = [obj.insertArgs() for obj in objs]
+        if cls.afterInsert is None:
+            if len(L) == 1:
+                return await execute(cls.__insert__, L[0])
+            return await executemany(cls.__insert__, L, autocommit = False)
+        async with transaction():
+            affected = await executemany(cls.__insert__, L)
+            await cls.afterInsert(objs)
+        return affected
+
+    async def save(self):
+        cls = self.__class__
+        # inside a transaction() the row must be part of it, not of a batch
+        if self.__batch_inserts__ and _batch_delay is not None and _transaction.get() is None:
+            if cls not in _batchers:
+                _batchers[cls] = InsertBatcher(cls, _batch_delay, _batch_rows)
+            rows = await _batchers[cls].insert(self)
+        else:
+            rows = await cls.insertRows([self])
         if rows != 1:
             logging.warn('failed to insert record: affected rows: {}'.format(rows))
 
     async def update(self):
-        args = list(map(self.getValue, self.__fields__))
+        self.beforeWrite()
+        # an object found with a projection only writes back the columns it loaded
+        fields = [f for f in self.__fields__ if f in self and f not in self.__derived__]
+        if not fields:
+            logging.warn('nothing to update: no column of {} is loaded'.format(self.__class__.__name__))
+            return
+        sql = self.__update__
+        if len(fields) < len(self.__fields__):
+            sql = 'update `{}` set {} where `{}`=?'.format(self.__table__, ', '.join(map(lambda f: '`{}`=?'.format(f), fields)), self.__primary_key__)
+        args = list(map(self.getValue, fields))
         args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        rows = await execute(sql, args)
         if rows != 1:
             logging.warn('failed to update by primary key: affected rows: {}'.format(rows))
+        self.afterChange([self.getValue(self.__primary_key__)])
 
     async def remove(self):
         args = [self.getValue(self.__primary_key__)]
         rows = await execute(self.__delete__, args)
         if rows != 1:
             logging.info('failed to remove by primary key: affected rows: {}'.format(rows))
+        self.afterChange(args)
+
+    @classmethod
+    async def saveMany(cls, objs):
+        ' insert objects with multi-row inserts, one transaction per batch. '
+        affected = 0
+        for chunk in chunks(list(objs)):
+            affected += await cls.insertRows(chunk)
+        return affected
+
+    @classmethod
+    async def updateMany(cls, objs, fields = None):
+        '''
+        Update objects by primary key, one transaction per batch. fields limits the columns written,
+        which all objects must have loaded. By default every object writes the columns it loaded,
+        so objects found with a projection, or without their deferred columns, do not blank the others.
+        '''
+        affected = 0
+        for chunk in chunks(list(objs)):
+            # objects writing the same columns share a statement
+            groups = dict()
+            for obj in chunk:
+                obj.beforeWrite()
+                if fields is None:
+                    written = tuple(f for f in cls.__fields__ if f in obj and f not in cls.__derived__)
+                else:
+                    written = tuple(fields)
+                    missing = [f for f in written if f not in obj]
+                    if missing:
+                        raise ValueError('Cannot update {} of {} {}: not loaded'.format(', '.join(missing), cls.__name__, obj.getValue(cls.__primary_key__)))
+                if not written:
+                    continue
+                args = list(map(obj.getValue, written))
+                args.append(obj.getValue(cls.__primary_key__))
+                groups.setdefault(written, []).append(args)
+            for written, L in groups.items():
+                sql = 'update `{}` set {} where `{}`=?'.format(cls.__table__, ', '.join(map(lambda f: '`{}`=?'.format(f), written)), cls.__primary_key__)
+                affected += await executemany(sql, L, autocommit = False)
+                cls.afterChange([args[-1] for args in L])
+        return affected
+
+    @classmethod
+    async def removeMany(cls, pks):
+        ' remove objects by primary keys, one statement per batch. '
+        affected = 0
+        for chunk in chunks(list(pks)):
+            sql = 'delete from `{}` where `{}` in ({})'.format(cls.__table__, cls.__primary_key__, create_args_string(len(chunk)))
+            affected += await execute(sql, chunk)
+            cls.afterChange(chunk)
+        return affected
 
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
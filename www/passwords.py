@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+'''
+Password hashing with a slow key derivation function, run on an executor so that sign-ins do not stall the event loop.
+
+Stored hashes name their algorithm and cost:
+
+    pbkdf2_sha256$<iterations>$<salt>$<hash>
+    scrypt$<n>$<r>$<p>$<salt>$<hash>
+
+Hashes without '$' are the legacy sha1('<user id>:<password>'), upgraded on the next sign-in.
+'''
+
+__author__ = 'Minty'
+
+import asyncio, base64, hashlib, hmac, os, time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from apis import APIError
+from config import configs
+from metrics import Counter, Gauge, Histogram
+
+hash_queue = Gauge('password_hash_queue', 'Password hashes waiting for a free executor worker.')
+hash_in_flight = Gauge('password_hash_in_flight', 'Password hashes running on the executor.')
+hash_seconds = Histogram('password_hash_seconds', 'Time to hash a password, waiting included.', ['op'])
+hash_rejected = Counter('password_hash_rejected_total', 'Password hashes refused because the queue was full.')
+
+def b64(data):
+    return base64.b64encode(data).decode('ascii').rstrip('=')
+
+def unb64(s):
+    return base64.b64decode(s + '=' * (-len(s) % 4))
+
+def make_hash(password, algorithm, cost, salt = None):
+    ' stored form of password. cost is (iterations,) for pbkdf2_sha256, (n, r, p) for scrypt. runs for long, keep it off the loop. '
+    salt = salt or os.urandom(16)
+    if algorithm == 'pbkdf2_sha256':
+        dk = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, *cost)
+    elif algorithm == 'scrypt':
+        n, r, p = cost
+        dk = hashlib.scrypt(password.encode('utf-8'), salt = salt, n = n, r = r, p = p, maxmem = 128 * n * r * p + 1024 * 1024, dklen = 32)
+    else:
+        raise ValueError('unknown password algorithm: {}'.format(algorithm))
+    return '$'.join([algorithm] + [str(c) for c in cost] + [b64(salt), b64(dk)])
+
+def parse_hash(stored):
+    ' (algorithm, cost, salt) of a stored hash. '
+    parts = stored.split('$')
+    return parts[0], tuple(int(c) for c in parts[1 : -2]), unb64(parts[-2])
+
+def check_hash(password, stored):
+    algorithm, cost, salt = parse_hash(stored)
+    return hmac.compare_digest(make_hash(password, algorithm, cost, salt), stored)
+
+def legacy_hash(uid, password):
+    return hashlib.sha1('{}:{}'.format(uid, password).encode('utf-8')).hexdigest()
+
+class PasswordHasher(object):
+    '''
+    Hash and verify passwords on a bounded executor: at most workers hashes run at once, at most max_pending wait.
+    Beyond that sign-ins are refused rather than queued for longer than anyone waits.
+    '''
+    def __init__(self, algorithm = 'pbkdf2_sha256', iterations = 260000, scrypt_n = 16384, scrypt_r = 8, scrypt_p = 1,
+            executor = 'thread', workers = 2, max_pending = 100):
+        self.algorithm = algorithm
+        self.cost = (iterations, ) if algorithm == 'pbkdf2_sha256' else (scrypt_n, scrypt_r, scrypt_p)
+        self.kind = executor
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._slots = None
+        self._pending = 0
+
+    async def _run(self, op, fn, *args):
+        if self._executor is None:
+            # made on first use, so that forked workers do not share the threads or processes of their parent
+            self._executor = (ProcessPoolExecutor if self.kind == 'process' else ThreadPoolExecutor)(self.workers)
+            self._slots = asyncio.Semaphore(self.workers)
+        if self._pending >= self.max_pending:
+            hash_rejected.inc()
+            raise APIError('password:busy', '', 'Too many sign-ins right now, please try again.')
+        started = time.perf_counter()
+        self._pending += 1
+        hash_queue.inc()
+        waiting = True
+        try:
+            async with self._slots:
+                waiting = False
+                self._pending -= 1
+                hash_queue.dec()
+                hash_in_flight.inc()
+                try:
+                    return await asyncio.get_event_loop().run_in_executor(self._executor, fn, *args)
+                finally:
+                    hash_in_flight.dec()
+        finally:
+            # a request cancelled while waiting leaves the queue too
+            if waiting:
+                self._pending -= 1
+                hash_queue.dec()
+            hash_seconds.observe(time.perf_counter() - started, op = op)
+
+    async def hash(self, password):
+        ' stored form of a new password. '
+        return await self._run('hash', make_hash, password, self.algorithm, self.cost)
+
+    async def verify(self, uid, password, stored):
+        '''
+        Check password against the stored hash of user uid. returns (matches, needs_rehash):
+        legacy hashes, and hashes of another algorithm or cost than configured, should be replaced.
+        '''
+        if '$' not in stored:
+            # legacy sha1 is cheap, no need for the executor
+            return hmac.compare_digest(legacy_hash(uid, password), stored), True
+        ok = await self._run('verify', check_hash, password, stored)
+        algorithm, cost, salt = parse_hash(stored)
+        return ok, (algorithm, cost) != (self.algorithm, self.cost)
+
+hasher = PasswordHasher(**configs.passwords)
@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+
+'''
+Full-text search over blogs: an inverted index ranked by BM25.
+
+The index is a snapshot file, mapped into memory so that every worker shares its pages,
+plus a journal of the changes made since the snapshot. Every worker replays the journal
+on top of the snapshot, and the journal is folded into a new snapshot once it grows.
+
+Locks, file reads and writes, fsync and compaction block, so the app runs them on a thread of the index:
+later() for writes, which requests do not wait for, run() for searches.
+
+Usage: python search.py    rebuild the index from the database
+'''
+
+__author__ = 'Minty'
+
+import asyncio, heapq, json, logging, math, mmap, os, re, struct
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from config import configs
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# term frequencies are counted with these weights, so that titles rank first
+FIELDS = (('name', 3), ('summary', 2), ('content', 1))
+
+# chinese, japanese and korean text has no spaces: it is indexed by overlapping character pairs
+_CJK = '぀-ヿ㐀-䶿一-鿿가-힯'
+_RE_TOKEN = re.compile('([{0}]+)|([^\\W_{0}]+)'.format(_CJK))
+
+def tokenize(text):
+    ' lower case words, and character pairs of cjk text. '
+    for cjk, word in _RE_TOKEN.findall((text or '').lower()):
+        if word:
+            yield word
+        elif len(cjk) == 1:
+            yield cjk
+        else:
+            for i in range(len(cjk) - 1):
+                yield cjk[i : i + 2]
+
+def analyze(blog):
+    ' weighted term frequencies of a blog, and its length. '
+    terms = dict()
+    for field, weight in FIELDS:
+        for term in tokenize(blog.get(field, None)):
+            terms[term] = terms.get(term, 0) + weight
+    return terms, sum(terms.values())
+
+'''
+Snapshot file layout, little endian:
+
+    header      magic, version, number of docs, number of terms, sum of doc lengths, section offsets
+    docs        per doc: id (ID_SIZE bytes, nul padded), length (u32)
+    terms       per term, sorted by term: offset and size of the term in the strings section,
+                offset of its postings, number of postings
+    strings     utf-8 terms
+    postings    per posting: doc number (u32), term frequency (u16)
+'''
+
+MAGIC = b'AWSI'
+VERSION = 1
+ID_SIZE = 50
+HEADER = struct.Struct('<4sIIIQQQQQ')
+DOC = struct.Struct('<{}sI'.format(ID_SIZE))
+TERM = struct.Struct('<IIQI')
+POSTING = struct.Struct('<IH')
+
+class Snapshot(object):
+    '''
+    Read only index of a snapshot file, looked up in place. An empty one when path does not exist.
+    '''
+    def __init__(self, path = None):
+        self.ident = None
+        self.docs = 0
+        self.terms = 0
+        self.total_length = 0
+        self._mm = None
+        if path is None or not os.path.exists(path):
+            return
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.ident = (st.st_ino, st.st_mtime_ns)
+            self._mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, version, self.docs, self.terms, self.total_length, self._docs_at, self._terms_at, self._strings_at, self._postings_at = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a search index of version {}'.format(path, VERSION))
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def doc(self, n):
+        ' (id, length) of doc number n. '
+        pk, length = DOC.unpack_from(self._mm, self._docs_at + n * DOC.size)
+        return pk.rstrip(b'\0').decode('ascii'), length
+
+    def _term(self, i):
+        offset, size, postings, df = TERM.unpack_from(self._mm, self._terms_at + i * TERM.size)
+        start = self._strings_at + offset
+        return self._mm[start : start + size], postings, df
+
+    def postings(self, term):
+        ' [(doc number, term frequency)] of a term, by binary search of the sorted terms. '
+        key = term.encode('utf-8')
+        lo, hi = 0, self.terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            t, postings, df = self._term(mid)
+            if t < key:
+                lo = mid + 1
+            elif t > key:
+                hi = mid
+            else:
+                start = self._postings_at + postings
+                return list(POSTING.iter_unpack(self._mm[start : start + df * POSTING.size]))
+        return []
+
+    def items(self):
+        ' every (term, [(doc number, term frequency)]). '
+        for i in range(self.terms):
+            t, postings, df = self._term(i)
+            start = self._postings_at + postings
+            yield t.decode('utf-8'), list(POSTING.iter_unpack(self._mm[start : start + df * POSTING.size]))
+
+def write_snapshot(path, docs, postings):
+    '''
+    Write docs [(id, length)] and postings {term: [(doc number, tf)]} as a snapshot, replacing path atomically.
+    '''
+    terms = sorted((t.encode('utf-8'), t) for t in postings)
+    docs_at = HEADER.size
+    terms_at = docs_at + len(docs) * DOC.size
+    strings_at = terms_at + len(terms) * TERM.size
+    strings = b''.join(key for key, t in terms)
+    postings_at = strings_at + len(strings)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(docs), len(terms), sum(length for pk, length in docs), docs_at, terms_at, strings_at, postings_at))
+        f.write(b''.join(DOC.pack(pk.encode('ascii'), length) for pk, length in docs))
+        offset = 0
+        position = 0
+        entries = []
+        for key, t in terms:
+            entries.append(TERM.pack(offset, len(key), position, len(postings[t])))
+            offset += len(key)
+            position += len(postings[t]) * POSTING.size
+        f.write(b''.join(entries))
+        f.write(strings)
+        for key, t in terms:
+            f.write(b''.join(POSTING.pack(n, min(tf, 0xffff)) for n, tf in postings[t]))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+class SearchIndex(object):
+    '''
+    Snapshot, plus the changes journaled since, kept in memory: docs added or changed,
+    and ids of snapshot docs which were removed or replaced.
+    '''
+    def __init__(self, path, compact_after = 1000):
+        self.path = path
+        self.compact_after = compact_after
+        self._snapshot = Snapshot()
+        self._executor = None
+        self._reset()
+
+    def _reset(self):
+        # id => (terms, length) of docs changed since the snapshot
+        self._docs = dict()
+        # term => {id: tf} of those docs
+        self._postings = dict()
+        # snapshot ids which no longer count
+        self._removed = set()
+        self._removed_length = 0
+        self._offset = 0
+        self._entries = 0
+        self._ids = None
+
+    @property
+    def _snapshot_path(self):
+        return os.path.join(self.path, 'blogs.idx')
+
+    @property
+    def _journal_path(self):
+        return os.path.join(self.path, 'blogs.journal')
+
+    def exists(self):
+        return os.path.exists(self._snapshot_path)
+
+    def _thread(self):
+        # one thread, so that the state of the index is only touched by it, and writes keep their order.
+        # made on first use, so that forked workers do not share the thread of their parent
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1)
+        return self._executor
+
+    async def run(self, fn, *args):
+        ' await fn(*args), a method of the index, on its thread. '
+        return await asyncio.get_event_loop().run_in_executor(self._thread(), fn, *args)
+
+    def later(self, fn, *args):
+        ' run fn(*args), a method of the index, on its thread without waiting for it. errors are logged. '
+        def logged():
+            try:
+                fn(*args)
+            except Exception:
+                logging.exception('search index: {} failed'.format(fn.__name__))
+        self._thread().submit(logged)
+
+    async def flush(self):
+        ' wait for the writes handed to later() so far. '
+        if self._executor is not None:
+            await self.run(lambda: None)
+
+    @contextmanager
+    def _lock(self, exclusive):
+        ' lock shared by the workers: writers hold it exclusively, readers shared. '
+        os.makedirs(self.path, exist_ok = True)
+        with open(os.path.join(self.path, 'lock'), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _snapshot_ids(self):
+        ' id => doc number of the snapshot, built when first needed. '
+        if self._ids is None:
+            self._ids = dict()
+            for n in range(self._snapshot.docs):
+                self._ids[self._snapshot.doc(n)[0]] = n
+        return self._ids
+
+    def _apply(self, entry):
+        pk = entry['id']
+        old = self._docs.pop(pk, None)
+        if old is not None:
+            for term in old[0]:
+                self._postings[term].pop(pk, None)
+                if not self._postings[term]:
+                    del self._postings[term]
+        elif pk not in self._removed:
+            n = self._snapshot_ids().get(pk, None)
+            if n is not None:
+                self._removed.add(pk)
+                self._removed_length += self._snapshot.doc(n)[1]
+        if entry['op'] == 'put':
+            self._docs[pk] = (entry['terms'], entry['length'])
+            for term, tf in entry['terms'].items():
+                self._postings.setdefault(term, dict())[pk] = tf
+        self._entries += 1
+
+    def _refresh(self):
+        ' map a new snapshot if another worker wrote one, and replay the journal. call with the lock held. '
+        try:
+            st = os.stat(self._snapshot_path)
+            ident = (st.st_ino, st.st_mtime_ns)
+        except FileNotFoundError:
+            ident = None
+        if ident != self._snapshot.ident:
+            self._snapshot.close()
+            self._snapshot = Snapshot(self._snapshot_path)
+            self._reset()
+        try:
+            with open(self._journal_path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        for line in data.splitlines():
+            self._apply(json.loads(line.decode('utf-8')))
+        self._offset += len(data)
+
+    def refresh(self):
+        ' catch up with changes of other workers. '
+        try:
+            if os.path.getsize(self._journal_path) == self._offset and self._snapshot.ident is not None:
+                st = os.stat(self._snapshot_path)
+                if (st.st_ino, st.st_mtime_ns) == self._snapshot.ident:
+                    return
+        except FileNotFoundError:
+            pass
+        with self._lock(False):
+            self._refresh()
+
+    def _write(self, entry):
+        with self._lock(True):
+            self._refresh()
+            line = json.dumps(entry, ensure_ascii = False, separators = (',', ':')).encode('utf-8') + b'\n'
+            with open(self._journal_path, 'ab') as f:
+                f.write(line)
+            self._offset += len(line)
+            self._apply(entry)
+            if self._entries >= self.compact_after:
+                self._compact()
+
+    def put(self, blog):
+        ' index a new or changed blog. '
+        terms, length = analyze(blog)
+        self._write(dict(op = 'put', id = blog.id, terms = terms, length = length))
+
+    def delete(self, pk):
+        self._write(dict(op = 'del', id = pk))
+
+    def _compact(self):
+        ' fold the journal into a new snapshot. call with the lock held exclusively. '
+        docs = []
+        numbers = dict()
+        for n in range(self._snapshot.docs):
+            pk, length = self._snapshot.doc(n)
+            if pk not in self._removed:
+                numbers[n] = len(docs)
+                docs.append((pk, length))
+        postings = dict()
+        for term, L in self._snapshot.items():
+            live = [(numbers[n], tf) for n, tf in L if n in numbers]
+            if live:
+                postings[term] = live
+        for pk, (terms, length) in self._docs.items():
+            n = len(docs)
+            docs.append((pk, length))
+            for term, tf in terms.items():
+                postings.setdefault(term, []).append((n, tf))
+        self._save(docs, postings)
+
+    def _save(self, docs, postings):
+        write_snapshot(self._snapshot_path, docs, postings)
+        # only writers holding the lock append, so the new snapshot has everything the journal had
+        with open(self._journal_path, 'wb'):
+            pass
+        self._refresh()
+        logging.info('search index saved: {} docs, {} terms'.format(len(docs), len(postings)))
+
+    def position(self):
+        ' where the index is: (snapshot, journal size). '
+        with self._lock(False):
+            self._refresh()
+            return self._snapshot.ident, self._offset
+
+    def rebuild(self, analyzed, since = None):
+        '''
+        Replace the index by analyzed {id: (terms, length)}, read from the database after position() returned since.
+        Changes journaled meanwhile are applied on top. Returns False, keeping the index, when another snapshot
+        was written meanwhile.
+        '''
+        with self._lock(True):
+            if since is not None:
+                ident, offset = since
+                self._refresh()
+                if self._snapshot.ident != ident:
+                    return False
+                try:
+                    with open(self._journal_path, 'rb') as f:
+                        f.seek(offset)
+                        data = f.read()
+                except FileNotFoundError:
+                    data = b''
+                for line in data.splitlines():
+                    entry = json.loads(line.decode('utf-8'))
+                    analyzed.pop(entry['id'], None)
+                    if entry['op'] == 'put':
+                        analyzed[entry['id']] = (entry['terms'], entry['length'])
+            docs = []
+            postings = dict()
+            for pk, (terms, length) in analyzed.items():
+                n = len(docs)
+                docs.append((pk, length))
+                for term, tf in terms.items():
+                    postings.setdefault(term, []).append((n, tf))
+            self._save(docs, postings)
+            return True
+
+    def search(self, query, offset = 0, limit = 10):
+        '''
+        Rank docs matching any term of query by BM25. returns (number of matches, [(id, score)] of one page).
+        '''
+        self.refresh()
+        snapshot = self._snapshot
+        N = snapshot.docs - len(self._removed) + len(self._docs)
+        if N <= 0:
+            return 0, []
+        total_length = snapshot.total_length - self._removed_length + sum(length for terms, length in self._docs.values())
+        avgdl = max(total_length / N, 1)
+        scores = dict()
+        for term in set(tokenize(query)):
+            matches = []
+            for n, tf in snapshot.postings(term):
+                pk, length = snapshot.doc(n)
+                if pk not in self._removed:
+                    matches.append((pk, tf, length))
+            for pk, tf in self._postings.get(term, dict()).items():
+                matches.append((pk, tf, self._docs[pk][1]))
+            if not matches:
+                continue
+            df = len(matches)
+            idf = math.log(1 + (N - df + 0.5) / (df + 0.5))
+            for pk, tf, length in matches:
+                scores[pk] = scores.get(pk, 0.0) + idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * length / avgdl))
+        top = heapq.nlargest(offset + limit, scores.items(), key = lambda item: item[1])
+        return len(scores), top[offset :]
+
+search_index = SearchIndex(os.path.join(os.path.dirname(os.path.abspath(__file__)), configs.search.path), configs.search.compact_after)
+
+async def rebuild(index = search_index, batch_size = 500):
+    ' rebuild the index from every blog of the database. '
+    from model import Blog
+    since = await index.run(index.position)
+    analyzed = dict()
+    async for blogs in Blog.iterate(batch_size = batch_size, columns = [f for f, weight in FIELDS]):
+        for blog in blogs:
+            analyzed[blog.id] = analyze(blog)
+    if not await index.run(index.rebuild, analyzed, since):
+        logging.warning('search index was rebuilt by another process meanwhile, keeping that one')
+    return len(analyzed)
+
+async def build(index = search_index):
+    '''
+    Build the index if there is none yet. Workers starting together take turns:
+    the first one builds, the others find the index built when their turn comes.
+    '''
+    if index.exists():
+        return False
+    os.makedirs(index.path, exist_ok = True)
+    with open(os.path.join(index.path, 'build.lock'), 'a') as f:
+        if fcntl is not None:
+            await asyncio.get_event_loop().run_in_executor(None, fcntl.flock, f.fileno(), fcntl.LOCK_EX)
+        try:
+            if index.exists():
+                return False
+            logging.info('building search index ...')
+            logging.info('indexed {} blogs'.format(await rebuild(index)))
+            return True
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+if __name__ == '__main__':
+    import orm
+    logging.basicConfig(level = logging.INFO)
+    async def main(loop):
+        await orm.create_pool(loop, **configs.db)
+        try:
+            logging.info('indexed {} blogs'.format(await rebuild()))
+        finally:
+            await orm.destroy_pool()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop))
+    loop.close()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+'''
+JSON serialization of api results, straight to utf-8 bytes.
+'''
+
+__author__ = 'Minty'
+
+import json, time
+
+from apis import Page
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# how to encode objects json does not know, by exact type.
+# Models are dict subclasses, both backends encode them natively without coming here
+ENCODERS = {
+    Page: lambda p: p.__dict__
+}
+
+def register(cls, fn):
+    ' add fn(obj) returning something json can encode for objects of cls. '
+    ENCODERS[cls] = fn
+
+def default(obj):
+    fn = ENCODERS.get(type(obj), None)
+    if fn is None:
+        raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+    return fn(obj)
+
+# built once: json.dumps() with options builds a new encoder on every call
+_encoder = json.JSONEncoder(ensure_ascii = False, separators = (',', ':'), default = default)
+
+def dumps_std(obj):
+    return _encoder.encode(obj).encode('utf-8')
+
+def dumps_fast(obj):
+    return orjson.dumps(obj, default = default)
+
+dumps = dumps_std if orjson is None else dumps_fast
+
+if __name__ == '__main__':
+    # micro-benchmark: a /api/blogs page the way the handlers used to encode it, and through dumps()
+    from model import Comment
+    comments = [Comment(id = '{:050d}'.format(i), blog_id = 'b' * 50, user_id = 'u' * 50, user_name = 'Minty',
+        user_image = 'http://www.gravatar.com/avatar/0?d=mm&s=120', content = '评论 comment ' * 40, created_at = time.time()) for i in range(100)]
+    result = dict(page = Page(1000, 3, 100), comments = comments)
+    def old(obj):
+        return json.dumps(obj, ensure_ascii = False, default = lambda o: o.__dict__).encode('utf-8')
+    candidates = [('json.dumps + lambda', old), ('dumps_std', dumps_std)]
+    if orjson is not None:
+        candidates.append(('dumps_fast (orjson)', dumps_fast))
+    n = 2000
+    for name, fn in candidates:
+        started = time.perf_counter()
+        for i in range(n):
+            fn(result)
+        elapsed = time.perf_counter() - started
+        print('{:<22} {:8.1f} us/op {:8d} bytes'.format(name, elapsed / n * 1e6, len(fn(result))))
@@ -1,4 +1,5 @@
 -- schema.sql
+-- generated from the models by schema_script.py, do not edit
 
 drop database if exists awesome;
 
@@ -8,11 +9,11 @@ use awesome;
 
 grant select, insert, update, delete on awesome.* to 'root'@'localhost' identified by 'password';
 
-create table users (
+create table `users` (
     `id` varchar(50) not null,
     `email` varchar(50) not null,
-    `password` varchar(50) not null,
-    `admin` bool not null,
+    `password` varchar(200) not null,
+    `admin` boolean not null,
     `name` varchar(50) not null,
     `image` varchar(500) not null,
     `created_at` real not null,
@@ -21,7 +22,7 @@ create table users (
     primary key (`id`)
 ) engine=innodb default charset=utf8;
 
-create table blogs (
+create table `blogs` (
     `id` varchar(50) not null,
     `user_id` varchar(50) not null,
     `user_name` varchar(50) not null,
@@ -29,19 +30,27 @@ create table blogs (
     `name` varchar(50) not null,
     `summary` varchar(200) not null,
     `content` mediumtext not null,
+    `html_content` mediumtext not null,
     `created_at` real not null,
+    `updated_at` real not null,
+    `comment_count` bigint not null,
+    `last_commented_at` real not null,
     key `idx_created_at` (`created_at`),
+    key `idx_updated_at` (`updated_at`),
+    key `idx_last_commented_at` (`last_commented_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
 
-create table comments (
+create table `comments` (
     `id` varchar(50) not null,
     `blog_id` varchar(50) not null,
     `user_id` varchar(50) not null,
     `user_name` varchar(50) not null,
     `user_image` varchar(500) not null,
     `content` mediumtext not null,
+    `html_content` mediumtext not null,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
+    key `idx_blog_id_created_at` (`blog_id`, `created_at`),
     primary key (`id`)
-) engine=innodb default charset=utf8;
\ No newline at end of file
+) engine=innodb default charset=utf8;
@@ -1,19 +1,132 @@
 # -*- coding: utf-8 -*-
 
-def create_tables(args):
-    sql = ['DROP database if EXISTS awesome;\nCREATE database awesome;'
-           '\nuse awesome;'
-           '\nGRANT SELECT, INSERT, UPDATE, DELETE on awesome. to "root"@"localhost" identified BY "password";\n']
-    for clz in args:
-        table_name = clz.table
-        sql.append('CREATE TABLE {} ('.format(table_name))
-        fields = clz.mappings
-        primary_key = None
-        for k, v in fields.items():
-            sql.append('`{}` {} NOT NULL,'.format(k, v.column_type))
-            if v.primary_key:
-                primary_key = k
-        if primary_key:
-            sql.append('primary key({})) engine=innodb default charset=utf8;\n'.format(primary_key))
-    with open('schema.sql', 'w', encoding='utf8') as f:
-        f.write(' '.join(sql))
\ No newline at end of file
+'''
+Database schema generated from the models.
+
+Usage:
+    python sql/schema_script.py                     write sql/schema.sql
+    python sql/schema_script.py migrate [--dry-run] create missing tables, widen varchar columns and add missing indexes to the live database
+    python sql/schema_script.py reconcile           repair the comment counts of blogs, after adding their columns or to fix drift
+'''
+
+__author__ = 'Minty'
+
+import asyncio, logging, os, re, sys
+
+# models live in www/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import orm
+from config import configs
+from model import User, Blog, Comment
+
+MODELS = [User, Blog, Comment]
+
+HEADER = '''-- schema.sql
+-- generated from the models by schema_script.py, do not edit
+
+drop database if exists awesome;
+
+create database awesome;
+
+use awesome;
+
+grant select, insert, update, delete on awesome.* to 'root'@'localhost' identified by 'password';
+'''
+
+def index_ddl(index):
+    return '{}key `{}` ({})'.format('unique ' if index.unique else '', index.name, ', '.join(map(lambda c: '`{}`'.format(c), index.columns)))
+
+def create_table(model):
+    ' create table statement of a model. '
+    lines = ['`{}` {} not null'.format(k, v.column_type) for k, v in model.__mappings__.items()]
+    lines.extend(map(index_ddl, model.__indexes__))
+    lines.append('primary key (`{}`)'.format(model.__primary_key__))
+    return 'create table `{}` (\n    {}\n) engine=innodb default charset=utf8;\n'.format(model.__table__, ',\n    '.join(lines))
+
+def create_tables(models = MODELS):
+    ' the whole schema script. '
+    return '\n'.join([HEADER] + list(map(create_table, models)))
+
+async def live_indexes(table):
+    ' {columns: index name} of a table in the live database. '
+    rs = await orm.select('select `index_name` `name`, `column_name` `column` from information_schema.statistics where `table_schema`=database() and `table_name`=? order by `index_name`, `seq_in_index`', [table])
+    indexes = dict()
+    for r in rs:
+        indexes.setdefault(r['name'], []).append(r['column'])
+    return {tuple(columns): name for name, columns in indexes.items()}
+
+async def live_columns(table):
+    ' {column: type} of a table in the live database. '
+    rs = await orm.select('select `column_name` `column`, `column_type` `type` from information_schema.columns where `table_schema`=database() and `table_name`=?', [table])
+    return {r['column']: r['type'] for r in rs}
+
+_RE_VARCHAR = re.compile(r'^varchar\((\d+)\)$')
+
+def widened(live, declared):
+    ' whether declared is a varchar longer than the live one. other changes of type are left to a person. '
+    a, b = _RE_VARCHAR.match(live.lower()), _RE_VARCHAR.match(declared.lower())
+    return a is not None and b is not None and int(b.group(1)) > int(a.group(1))
+
+async def migrate(models = MODELS, dry_run = False):
+    '''
+    Create missing tables, widen varchar columns declared longer than they are, and add missing indexes.
+    Indexes are built online, the table stays readable and writable, while widening copies the table.
+    Missing columns are reported with the statement to add them, but left alone.
+    '''
+    statements = []
+    for model in models:
+        columns = await live_columns(model.__table__)
+        if not columns:
+            statements.append(create_table(model))
+            continue
+        for k, v in model.__mappings__.items():
+            if k not in columns:
+                logging.warning('missing column {}.{}, add it with: alter table `{}` add column `{}` {} not null;'.format(model.__table__, k, model.__table__, k, v.column_type))
+            elif widened(columns[k], v.column_type):
+                # like users.password, from varchar(50) of sha1 hashes to the longer ones of passwords.py
+                statements.append('alter table `{}` modify column `{}` {} not null'.format(model.__table__, k, v.column_type))
+        existing = await live_indexes(model.__table__)
+        for index in model.__indexes__:
+            # any index on the same columns will do, whatever its name
+            if tuple(index.columns) in existing:
+                continue
+            if not all(c in columns for c in index.columns):
+                logging.warning('skipped index {}.{}, add its columns first'.format(model.__table__, index.name))
+                continue
+            statements.append('alter table `{}` add {}, algorithm=inplace, lock=none'.format(model.__table__, index_ddl(index)))
+    for sql in statements:
+        logging.info(sql)
+        if not dry_run:
+            await orm.execute(sql, [])
+    if not statements:
+        logging.info('schema is up to date')
+    return statements
+
+def main(argv):
+    if not argv:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')
+        with open(path, 'w', encoding = 'utf8') as f:
+            f.write(create_tables())
+        logging.info('wrote {}'.format(path))
+        return
+    if argv[0] not in ('migrate', 'reconcile'):
+        print(__doc__)
+        return
+    async def run(loop):
+        # information_schema and counts of the primary: replicas may lag behind
+        await orm.create_pool(loop, **dict(configs.db, replicas = []))
+        try:
+            if argv[0] == 'migrate':
+                await migrate(dry_run = '--dry-run' in argv)
+            else:
+                logging.info('repaired {} blogs'.format(await Blog.reconcile()))
+        finally:
+            await orm.destroy_pool()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(loop))
+    loop.close()
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO)
+    main(sys.argv[1:])
@@ -118,12 +118,32 @@ function parseQueryString() {
     return r;
 }
 
-function gotoPage(i) {
+function gotoPage(i, direction, cursor) {
     var r = parseQueryString();
     r.page = i;
+    delete r.after;
+    delete r.before;
+    if (direction && cursor) {
+        r[direction] = cursor;
+    }
     location.assign('?' + $.param(r));
 }
 
+// page/cursor arguments for a paged api call, taken from the current location:
+
+function pageQuery(page_index) {
+    var
+        r = parseQueryString(),
+        q = { page: page_index };
+    if (r.after) {
+        q.after = r.after;
+    }
+    else if (r.before) {
+        q.before = r.before;
+    }
+    return q;
+}
+
 function refresh() {
     var
         t = new Date().getTime(),
@@ -360,10 +380,10 @@ if (typeof(Vue)!=='undefined') {
     Vue.component('pagination', {
         template: '<ul class="uk-pagination">' +
                 '<li v-if="! has_previous" class="uk-disabled"><span><i class="uk-icon-angle-double-left"></i></span></li>' +
-                '<li v-if="has_previous"><a v-attr="onclick:\'gotoPage(\' + (page_index-1) + \')\'" href="#0"><i class="uk-icon-angle-double-left"></i></a></li>' +
+                '<li v-if="has_previous"><a v-attr="onclick:\'gotoPage(\' + (page_index-1) + \', \\\'before\\\', \\\'\' + (previous_cursor || \'\') + \'\\\')\'" href="#0"><i class="uk-icon-angle-double-left"></i></a></li>' +
                 '<li class="uk-active"><span v-text="page_index"></span></li>' +
                 '<li v-if="! has_next" class="uk-disabled"><span><i class="uk-icon-angle-double-right"></i></span></li>' +
-                '<li v-if="has_next"><a v-attr="onclick:\'gotoPage(\' + (page_index+1) + \')\'" href="#0"><i class="uk-icon-angle-double-right"></i></a></li>' +
+                '<li v-if="has_next"><a v-attr="onclick:\'gotoPage(\' + (page_index+1) + \', \\\'after\\\', \\\'\' + (next_cursor || \'\') + \'\\\')\'" href="#0"><i class="uk-icon-angle-double-right"></i></a></li>' +
             '</ul>'
     });
 }
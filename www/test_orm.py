@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the writes of the orm which do not need a database: the statements they run are recorded instead.
+
+Usage: python -m pytest test_orm.py (or python -m unittest test_orm), from www/
+'''
+
+__author__ = 'Minty'
+
+import asyncio, unittest, unittest.mock
+
+import orm
+from model import Blog
+
+class Recorder(object):
+    ' stands for orm.executemany, and keeps (sql, rows) of every call. '
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, sql, seq_of_args, autocommit = True):
+        self.calls.append((sql, seq_of_args))
+        return len(seq_of_args)
+
+class UpdateManyTest(unittest.TestCase):
+
+    def update(self, objs, **kw):
+        recorder = Recorder()
+        with unittest.mock.patch.object(orm, 'executemany', recorder):
+            affected = asyncio.run(Blog.updateMany(objs, **kw))
+        return affected, recorder.calls
+
+    def test_deferred_columns_are_not_written(self):
+        # as findAll() loads them: without content and html_content, which are deferred
+        blogs = [Blog(id = str(i), user_id = 'u', user_name = 'n', user_image = 'i', name = 'blog {}'.format(i), summary = 's',
+            created_at = 1.0, updated_at = 1.0, comment_count = 3, last_commented_at = 2.0) for i in range(3)]
+        affected, calls = self.update(blogs)
+        self.assertEqual(affected, 3)
+        self.assertEqual(len(calls), 1)
+        sql, rows = calls[0]
+        self.assertNotIn('content', sql)
+        # derived columns are kept by their own statements
+        self.assertNotIn('comment_count', sql)
+        self.assertIn('`name`=?', sql)
+        self.assertEqual(rows[0][-1], '0')
+
+    def test_objects_with_different_columns(self):
+        blogs = [Blog(id = 'a', name = 'a'), Blog(id = 'b', name = 'b', content = 'body')]
+        affected, calls = self.update(blogs)
+        self.assertEqual(affected, 2)
+        self.assertEqual(len(calls), 2)
+        # beforeWrite() renders the html of a blog whose content was loaded
+        self.assertIn('`html_content`=?', calls[1][0])
+        self.assertNotIn('content', calls[0][0])
+
+    def test_fields_must_be_loaded(self):
+        with self.assertRaises(ValueError):
+            self.update([Blog(id = 'a', name = 'a')], fields = ['summary'])
+
+    def test_fields(self):
+        affected, calls = self.update([Blog(id = 'a', name = 'a', summary = 's')], fields = ['summary'])
+        self.assertEqual(calls, [('update `blogs` set `summary`=? where `id`=?', [['s', 'a']])])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the search index: snapshot and journal round trips, and BM25 ranking.
+
+Usage: python -m pytest test_search.py (or python -m unittest test_search), from www/
+'''
+
+__author__ = 'Minty'
+
+import asyncio, os, shutil, tempfile, unittest, unittest.mock
+
+from search import Snapshot, SearchIndex, analyze, tokenize, write_snapshot
+
+def blog(id, name = '', summary = '', content = ''):
+    return dict(id = id, name = name, summary = summary, content = content)
+
+class Blog(dict):
+    ' the index reads blog.id, like the models. '
+    def __getattr__(self, key):
+        return self[key]
+
+class SearchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def index(self, compact_after = 1000):
+        return SearchIndex(self.path, compact_after)
+
+    def ids(self, index, query):
+        return [pk for pk, score in index.search(query, 0, 100)[1]]
+
+class SnapshotTest(SearchTestCase):
+
+    def test_write_and_read(self):
+        path = os.path.join(self.path, 'blogs.idx')
+        write_snapshot(path, [('a', 3), ('b', 5)], {'python': [(0, 2), (1, 1)], '数据': [(1, 4)]})
+        snapshot = Snapshot(path)
+        try:
+            self.assertEqual(snapshot.docs, 2)
+            self.assertEqual(snapshot.total_length, 8)
+            self.assertEqual(snapshot.doc(1), ('b', 5))
+            self.assertEqual(snapshot.postings('python'), [(0, 2), (1, 1)])
+            self.assertEqual(snapshot.postings('数据'), [(1, 4)])
+            self.assertEqual(snapshot.postings('missing'), [])
+            self.assertEqual(dict(snapshot.items()), {'python': [(0, 2), (1, 1)], '数据': [(1, 4)]})
+        finally:
+            snapshot.close()
+
+    def test_missing_file_is_empty(self):
+        snapshot = Snapshot(os.path.join(self.path, 'none.idx'))
+        self.assertEqual(snapshot.docs, 0)
+        self.assertIsNone(snapshot.ident)
+
+class JournalTest(SearchTestCase):
+
+    def test_other_instance_replays_journal(self):
+        writer, reader = self.index(), self.index()
+        writer.put(Blog(blog('a', name = 'asyncio tips')))
+        writer.put(Blog(blog('b', content = 'asyncio internals')))
+        self.assertEqual(sorted(self.ids(reader, 'asyncio')), ['a', 'b'])
+        writer.delete('a')
+        self.assertEqual(self.ids(reader, 'asyncio'), ['b'])
+
+    def test_compaction_keeps_everything(self):
+        writer, reader = self.index(compact_after = 3), self.index()
+        for pk in 'abc':
+            writer.put(Blog(blog(pk, name = 'python {}'.format(pk))))
+        # the third write folded the journal into a snapshot
+        self.assertTrue(writer.exists())
+        self.assertEqual(os.path.getsize(os.path.join(self.path, 'blogs.journal')), 0)
+        writer.delete('b')
+        writer.put(Blog(blog('a', name = 'rust')))
+        self.assertEqual(self.ids(reader, 'python'), ['c'])
+        self.assertEqual(self.ids(reader, 'rust'), ['a'])
+        self.assertEqual(reader.search('python')[0], 1)
+
+    def test_rebuild_applies_writes_made_meanwhile(self):
+        index = self.index()
+        since = index.position()
+        analyzed = {'a': analyze(blog('a', name = 'old')), 'b': analyze(blog('b', name = 'old'))}
+        # written while the rebuild read the database
+        index.put(Blog(blog('a', name = 'new')))
+        self.assertTrue(index.rebuild(analyzed, since))
+        self.assertEqual(self.ids(self.index(), 'old'), ['b'])
+        self.assertEqual(self.ids(self.index(), 'new'), ['a'])
+
+    def test_background_thread(self):
+        index = self.index()
+        async def run():
+            index.later(index.put, Blog(blog('a', name = 'queued')))
+            await index.flush()
+            return await index.run(index.search, 'queued')
+        self.assertEqual(asyncio.run(run()), (1, [('a', unittest.mock.ANY)]))
+
+class RankingTest(SearchTestCase):
+
+    def test_tokenize(self):
+        self.assertEqual(list(tokenize('Hello, World_2 数据库')), ['hello', 'world', '2', '数据', '据库'])
+
+    def test_title_ranks_above_content(self):
+        index = self.index()
+        index.put(Blog(blog('body', content = 'python')))
+        index.put(Blog(blog('title', name = 'python')))
+        self.assertEqual(self.ids(index, 'python'), ['title', 'body'])
+
+    def test_shorter_doc_ranks_first(self):
+        index = self.index()
+        index.put(Blog(blog('long', content = 'python ' + 'filler ' * 50)))
+        index.put(Blog(blog('short', content = 'python filler')))
+        self.assertEqual(self.ids(index, 'python'), ['short', 'long'])
+
+    def test_rare_term_weighs_more(self):
+        index = self.index()
+        for i in range(5):
+            index.put(Blog(blog('common{}'.format(i), content = 'web')))
+        index.put(Blog(blog('rare', content = 'aiohttp')))
+        # one match of the rare term beats one match of the common one
+        self.assertEqual(self.ids(index, 'web aiohttp')[0], 'rare')
+
+    def test_paging(self):
+        index = self.index()
+        for i in range(5):
+            index.put(Blog(blog(str(i), content = 'python ' + 'x ' * i)))
+        total, page = index.search('python', 2, 2)
+        self.assertEqual(total, 5)
+        self.assertEqual([pk for pk, score in page], ['2', '3'])
+
+if __name__ == '__main__':
+    unittest.main()